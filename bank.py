@@ -0,0 +1,135 @@
+"""
+Binary show library of patterns.
+
+A bank file is the 8-byte `MAGIC`, a `HEADER` of
+    uint16 steps per pattern, uint16 channels per pattern, uint32 pattern count
+and then one fixed-size record per pattern (see `record_dtype`):
+    title (TITLE_LEN bytes, utf-8, NUL padded),
+    keybinding (2 x uint16, NO_KEY for none),
+    per channel: type (uint8, 0 for none, else 1 + index into `CHANNEL_TYPES`),
+                 RGBA colour (4 x uint8), width (uint16 fracs),
+    per channel: steps, one bit each, most significant bit first.
+All fields are little-endian with no padding, so `PatternBank` reads the
+records in place through `mmap` and only builds a `Pattern` when one is
+first asked for.
+
+Usage: python bank.py BANK
+"""
+import logging
+import mmap
+import struct
+import sys
+
+import numpy
+
+from channels import CHANNEL_TYPES, make_channel
+from patterns import Pattern
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CLBANK1\n"
+HEADER = struct.Struct("<HHI")
+TITLE_LEN = 32
+NO_KEY = 0xffff
+
+CHANNEL = numpy.dtype([("type", "u1"), ("color", "u1", 4), ("width", "<u2")])
+
+def record_dtype(seq_len=Pattern.SEQ_LEN, channels=Pattern.CHANNELS):
+    return numpy.dtype([
+        ("title", "S%d" % TITLE_LEN),
+        ("keys", "<u2", 2),
+        ("channels", CHANNEL, channels),
+        ("steps", "u1", (channels, (seq_len + 7) // 8)),
+    ])
+
+def write_bank(path, patterns):
+    """
+    Write `patterns` to a bank file. Steps are stored as on/off, and
+    titles longer than `TITLE_LEN` bytes are cut short.
+    """
+    records = numpy.zeros(len(patterns), dtype=record_dtype())
+    for record, pattern in zip(records, patterns):
+        record["title"] = pattern.title.encode("utf-8")[:TITLE_LEN]
+        record["keys"] = [NO_KEY if k is None else k for k in pattern.keybinding]
+        for desc, channel in zip(record["channels"], pattern.channels):
+            if not channel:
+                continue
+            d = channel.describe()
+            desc["type"] = 1 + [cls.name for cls in CHANNEL_TYPES].index(d["type"])
+            desc["color"] = d.get("color", [0, 0, 0, 0])
+            desc["width"] = d.get("width", 0)
+        record["steps"] = numpy.packbits(pattern.data != 0, axis=1)
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER.pack(Pattern.SEQ_LEN, Pattern.CHANNELS, len(records)))
+        f.write(records.tobytes())
+
+class PatternBank(object):
+    """
+    Read-only view of a bank file.
+    `bank[i]` builds pattern `i` (with channels on `device_manager`'s
+    default group) the first time it is asked for and keeps it;
+    `title(i)` reads a title without building anything.
+    """
+    def __init__(self, path, device_manager):
+        self.path = path
+        self.device_manager = device_manager
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[0:len(MAGIC)] != MAGIC:
+            raise Exception("%s is not a pattern bank" % path)
+        seq_len, channels, count = HEADER.unpack_from(self.mm, len(MAGIC))
+        if (seq_len, channels) != (Pattern.SEQ_LEN, Pattern.CHANNELS):
+            raise Exception("%s holds %d steps x %d channels; patterns are %d x %d"
+                            % (path, seq_len, channels, Pattern.SEQ_LEN, Pattern.CHANNELS))
+        dtype = record_dtype(seq_len, channels)
+        offset = len(MAGIC) + HEADER.size
+        if offset + count * dtype.itemsize > len(self.mm):
+            raise Exception("%s is truncated" % path)
+        self.records = numpy.frombuffer(self.mm, dtype=dtype, count=count, offset=offset)
+        self.loaded = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def title(self, i):
+        return self.records[i]["title"].decode("utf-8", "replace")
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i not in self.loaded:
+            self.loaded[i] = self.materialize(i)
+        return self.loaded[i]
+
+    def materialize(self, i):
+        record = self.records[i]
+        p = Pattern(self.device_manager, name=self.title(i))
+        p.data = numpy.unpackbits(record["steps"], axis=1)[:, :Pattern.SEQ_LEN]
+        p.keybinding = tuple(None if k == NO_KEY else int(k) for k in record["keys"])
+        group = self.device_manager.default_group if self.device_manager is not None else None
+        channels = []
+        for desc in record["channels"]:
+            if desc["type"] == 0:
+                channels.append(None)
+                continue
+            cls = CHANNEL_TYPES[desc["type"] - 1]
+            channels.append(make_channel(group, {"type": cls.name, "color": desc["color"].tolist(), "width": int(desc["width"])}))
+        p.channels = channels
+        return p
+
+    def close(self):
+        # Any pattern already built stays usable
+        self.records = None
+        self.mm.close()
+
+def main(args):
+    for path in args:
+        bank = PatternBank(path, None)
+        print "{}: {} patterns".format(path, len(bank))
+        for i in range(len(bank)):
+            print "{:>5} {}".format(i, bank.title(i))
+        bank.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,273 @@
+"""
+Streaming beat tracker.
+
+`BeatDetector` takes mono PCM in chunks of any size and keeps a spectral
+flux onset envelope of the last few seconds. A few times a second it picks
+the tempo from the envelope's autocorrelation and the phase from a comb
+over the last few beats. `BeatTracker` runs a detector on a live raw PCM
+stream (e.g. the output of `arecord`) and keeps a `Timebase` locked to it.
+
+Usage: python beatdetect.py WAV [WAV ...]
+       arecord -q -f S16_LE -r 44100 -c 1 -t raw | python beatdetect.py -
+"""
+import collections
+import logging
+import sys
+import threading
+import time
+import wave
+
+import numpy
+
+from timing import monotonic_ns
+
+logger = logging.getLogger(__name__)
+
+class BeatDetector(object):
+    """
+    Onset envelope: the half-wave rectified increase in log spectral
+    magnitude between frames `hop` samples apart, each windowed over
+    `fft_size` samples. `history` seconds of it are kept in a ring, along
+    with the same for the bins below `bass_hz` alone.
+
+    Every `update_interval` seconds the tempo is re-estimated from the
+    envelope's autocorrelation, scoring each lag together with its double
+    and weighting towards `prior_bpm` to avoid octave errors; the period
+    is smoothed across estimates. The latest beat is where a comb at that
+    period lines up best with the last `comb_beats` beats of the bass
+    envelope, since hats and snares mostly fall off the beat.
+
+    Times are in seconds of stream (samples fed / rate).
+    `confidence` is the normalized autocorrelation at the chosen lag.
+    """
+    def __init__(self, rate=44100, hop=512, fft_size=1024, history=6.0, update_interval=0.25,
+                 min_bpm=70, max_bpm=180, prior_bpm=120, comb_beats=4, smoothing=0.3, bass_hz=150):
+        self.rate = rate
+        self.hop = hop
+        self.fft_size = fft_size
+        self.frame_rate = float(rate) / hop
+        self.min_bpm = min_bpm
+        self.max_bpm = max_bpm
+        self.comb_beats = comb_beats
+        self.smoothing = smoothing
+
+        self.window = numpy.hanning(fft_size)
+        self.frame = numpy.zeros(fft_size)
+        self.pending = numpy.zeros(0)
+        self.last_spectrum = numpy.zeros(fft_size // 2 + 1)
+        self.envelope = numpy.zeros(int(history * self.frame_rate))
+        self.bass_envelope = numpy.zeros(len(self.envelope))
+        self.bass_bins = max(int(bass_hz * fft_size / rate), 1) + 1
+        self.frames = 0
+        self.update_frames = max(int(update_interval * self.frame_rate), 1)
+
+        # Lags (in frames) worth considering, and how plausible each tempo is
+        self.lags = numpy.arange(int(60 * self.frame_rate / max_bpm), int(60 * self.frame_rate / min_bpm) + 1)
+        bpms = 60 * self.frame_rate / self.lags
+        self.prior = numpy.exp(-0.5 * (numpy.log2(bpms / prior_bpm) / 0.9) ** 2)
+
+        self.period = None
+        self.beat_time = None
+        self.confidence = 0.0
+
+    @property
+    def time(self):
+        # Stream time of the end of the last complete frame
+        return float(self.frames * self.hop) / self.rate
+
+    @property
+    def bpm(self):
+        return 60.0 / self.period if self.period else None
+
+    def feed(self, samples):
+        # Returns True if the estimate was updated
+        samples = numpy.asarray(samples, dtype=float)
+        if self.pending.size:
+            samples = numpy.concatenate([self.pending, samples])
+        hop = self.hop
+        updated = False
+        n = len(samples) // hop
+        for i in range(n):
+            self.onset(samples[i * hop:(i + 1) * hop])
+            if self.frames % self.update_frames == 0:
+                updated = self.estimate() or updated
+        self.pending = samples[n * hop:]
+        return updated
+
+    def onset(self, block):
+        frame = self.frame
+        frame[:-self.hop] = frame[self.hop:]
+        frame[-self.hop:] = block
+        spectrum = numpy.log1p(numpy.abs(numpy.fft.rfft(frame * self.window)))
+        flux = numpy.maximum(spectrum - self.last_spectrum, 0)
+        self.last_spectrum = spectrum
+        i = self.frames % len(self.envelope)
+        self.envelope[i] = flux.sum()
+        self.bass_envelope[i] = flux[:self.bass_bins].sum()
+        self.frames += 1
+
+    def recent(self, envelope):
+        # `envelope` in time order, oldest first
+        n = len(envelope)
+        if self.frames < n:
+            return envelope[:self.frames]
+        i = self.frames % n
+        return numpy.concatenate([envelope[i:], envelope[:i]])
+
+    def estimate(self):
+        recent = self.recent(self.envelope)
+        n = len(recent)
+        if n < 2 * self.lags[-1] + 2:
+            return False
+        env = recent - recent.mean()
+        spectrum = numpy.fft.rfft(env, 2 * n)
+        ac = numpy.fft.irfft(spectrum * numpy.conj(spectrum))[:n]
+        if ac[0] <= 0:
+            return False
+        ac /= ac[0]
+
+        lags = self.lags
+        scores = (ac[lags] + 0.5 * ac[numpy.minimum(2 * lags, n - 1)]) * self.prior
+        best = int(numpy.argmax(scores))
+        lag = float(lags[best])
+        if 0 < best < len(lags) - 1:
+            # Parabolic interpolation between lags
+            a, b, c = scores[best - 1:best + 2]
+            denom = a - 2 * b + c
+            if denom < 0:
+                lag += 0.5 * (a - c) / denom
+        if 2 * lags[best] < n - 1:
+            # The second peak pins the lag down twice as finely
+            l2 = int(round(2 * lag))
+            if 0 < l2 < n - 1:
+                a, b, c = ac[l2 - 1:l2 + 2]
+                denom = a - 2 * b + c
+                if denom < 0:
+                    lag = (l2 + 0.5 * (a - c) / denom) / 2
+        period = lag / self.frame_rate
+
+        self.confidence = max(float(ac[lags[best]]), 0.0)
+        if self.period is None or abs(period - self.period) > 0.08 * self.period:
+            self.period = period
+        else:
+            self.period += self.smoothing * (period - self.period)
+
+        # Phase: the offset back from now at which a comb of beats collects the most onset energy
+        lag = self.period * self.frame_rate
+        beats = min(self.comb_beats, int((n - 1) / lag))
+        offsets = numpy.arange(int(lag))
+        idx = (n - 1 - offsets[:, None] - numpy.round(numpy.arange(beats) * lag)[None, :]).astype(int)
+        bass = self.recent(self.bass_envelope)
+        if not bass.any():
+            bass = recent
+        offset = int(numpy.argmax(bass[idx].sum(axis=1)))
+        # Flux peaks in the frame that first has the onset in its last hop
+        self.beat_time = self.time - (offset + 0.5) * self.hop / float(self.rate)
+        return True
+
+class BeatTracker(object):
+    """
+    Feeds `source` (a file of raw signed 16-bit mono PCM, read as it arrives)
+    to a `BeatDetector` on a background thread and keeps `timebase` locked
+    to the beat while the detector is at least `min_confidence` sure.
+
+    The tempo is always followed; the phase is only corrected when it is off
+    by more than `phase_tolerance` of a beat, so the beat does not jitter.
+    `latency` is how far the audio lags behind the room, in seconds.
+    """
+    def __init__(self, timebase, source, detector=None, min_confidence=0.3, phase_tolerance=0.05, latency=0.0):
+        self.timebase = timebase
+        self.source = source
+        self.detector = detector or BeatDetector()
+        self.min_confidence = min_confidence
+        self.phase_tolerance = phase_tolerance
+        self.latency = latency
+        self.process_time = collections.deque(maxlen=1024)
+        self.corrections = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        chunk = self.detector.hop * 2
+        while self.running:
+            data = self.source.read(chunk)
+            if not data:
+                logger.warning("Audio input ended")
+                return
+            now = monotonic_ns()
+            start = time.time()
+            if self.detector.feed(numpy.frombuffer(data[:len(data) // 2 * 2], dtype="<i2")):
+                self.follow(now)
+            self.process_time.append(time.time() - start)
+
+    def follow(self, now):
+        det = self.detector
+        if det.confidence < self.min_confidence or det.period is None:
+            return
+        tb = self.timebase
+        period_ns = int(det.period * 1e9)
+        beat_ns = now - int((det.time - det.beat_time + self.latency) * 1e9)
+        frac = tb.position(beat_ns) % tb.fracs
+        error = min(frac, tb.fracs - frac)
+        if error > self.phase_tolerance * tb.fracs:
+            tb.set_phase_ns(beat_ns, period_ns)
+            self.corrections += 1
+        else:
+            tb.set_period_ns(period_ns)
+
+def read_wav(path):
+    # Returns (mono float samples, rate)
+    w = wave.open(path, "rb")
+    try:
+        channels, width, rate, frames = w.getnchannels(), w.getsampwidth(), w.getframerate(), w.getnframes()
+        data = w.readframes(frames)
+    finally:
+        w.close()
+    if width == 1:
+        samples = numpy.frombuffer(data, dtype=numpy.uint8).astype(float) - 128
+    elif width == 2:
+        samples = numpy.frombuffer(data, dtype="<i2").astype(float)
+    elif width == 4:
+        samples = numpy.frombuffer(data, dtype="<i4").astype(float)
+    else:
+        raise Exception("Unsupported sample width %d in %s" % (width, path))
+    return samples.reshape(-1, channels).mean(axis=1), rate
+
+def detect_file(path, chunk=1024, **kwargs):
+    """
+    Run a detector over a WAV file as if it were streaming in.
+    Returns the detector and the processing time of every chunk.
+    """
+    samples, rate = read_wav(path)
+    det = BeatDetector(rate=rate, **kwargs)
+    times = []
+    for i in range(0, len(samples), chunk):
+        start = time.time()
+        det.feed(samples[i:i + chunk])
+        times.append(time.time() - start)
+    return det, times
+
+def main(args):
+    if args == ["-"]:
+        det = BeatDetector()
+        while True:
+            data = sys.stdin.read(det.hop * 2)
+            if not data:
+                return
+            if det.feed(numpy.frombuffer(data[:len(data) // 2 * 2], dtype="<i2")) and det.period:
+                print "{:.1f} BPM, beat at {:.3f}s, confidence {:.2f}".format(det.bpm, det.beat_time, det.confidence)
+    for path in args:
+        det, times = detect_file(path)
+        print "{}: {} BPM, confidence {:.2f}, {:.2f}ms per chunk".format(
+                path, "{:.1f}".format(det.bpm) if det.period else "no", det.confidence, 1000 * sum(times) / len(times))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
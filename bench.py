@@ -0,0 +1,958 @@
+"""
+Micro-benchmarks for the output path.
+
+Usage: python bench.py [benchmark ...]
+Runs every benchmark if none are named.
+"""
+import os
+import random
+import sys
+import threading
+import time
+
+from devices import *
+from framing import *
+from stats import format_bytes, format_seconds
+from timing import *
+
+def legacy_encode(data, flags=0x00, addr=0x00):
+    # The original list-based `framed_packet` -> `cobs_packet` -> `raw_packet` path
+    data = list(data)
+    while len(data) < 8:
+        data.append(0)
+    crc_frame = [flags, addr] + data
+    checksum = sum(crc_frame) & 0xff
+    frame = [len(data), checksum] + crc_frame
+    rdata = []
+    i = 0
+    for d in frame[::-1]:
+        i += 1
+        if d == 0:
+            rdata.append(i)
+            i = 0
+        else:
+            rdata.append(d)
+    return "".join([chr(d) for d in [0, i+1] + rdata[::-1]])
+
+def sample_commands(n=1000, seed=0):
+    # A mix resembling show traffic: ticks, strobe messages and effect adds/stops
+    rng = random.Random(seed)
+    dev = SingleBespeckleDevice
+    cmds = []
+    for i in range(n):
+        r = rng.random()
+        if r < 0.5:
+            cmds.append([dev.CMD_TICK])
+        elif r < 0.8:
+            cmds.append([dev.CMD_MSG, rng.randrange(256)] + [rng.choice([0, 0xff, rng.randrange(256)]) for j in range(6)])
+        elif r < 0.9:
+            cmds.append([rng.randrange(0x10, 0x30), rng.randrange(256)])
+        else:
+            cmds.append([dev.CMD_STOP, rng.randrange(256)])
+    return cmds
+
+def timed_rate(fn, items, duration=1.0):
+    count = 0
+    start = time.time()
+    while True:
+        for item in items:
+            fn(item)
+        count += len(items)
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+def bench_encoder():
+    cmds = sample_commands()
+    encoder = FrameEncoder()
+
+    # Random payloads of every length must encode identically
+    rng = random.Random(1)
+    for i in range(5000):
+        data = [rng.choice([0, rng.randrange(256)]) for j in range(rng.randrange(MAX_DATA_LEN + 1))]
+        flags, addr = rng.randrange(256), rng.choice([0, rng.randrange(256)])
+        assert legacy_encode(data, flags, addr) == encoder.encode(data, flags, addr), data
+    for cmd in cmds:
+        assert legacy_encode(cmd) == encoder.encode(cmd) == encoder.cached(cmd)
+    print "Output is byte-identical to the legacy encoder"
+
+    ticks = [[SingleBespeckleDevice.CMD_TICK]] * 100
+    results = [
+        ("legacy, mixed", timed_rate(legacy_encode, cmds)),
+        ("encoder, mixed", timed_rate(encoder.encode, cmds)),
+        ("legacy, ticks", timed_rate(legacy_encode, ticks)),
+        ("encoder, ticks", timed_rate(encoder.encode, ticks)),
+        ("cached, ticks", timed_rate(encoder.cached, ticks)),
+    ]
+    for name, rate in results:
+        print "{:<16} {:>10.0f} packets/sec".format(name, rate)
+
+def open_pty_ports(n):
+    # Serial ports backed by pty pairs; the master ends are drained in the background
+    ports = []
+    for i in range(n):
+        master, slave = os.openpty()
+        ports.append(os.ttyname(slave))
+        def drain(fd=master):
+            while True:
+                os.read(fd, 4096)
+        t = threading.Thread(target=drain)
+        t.daemon = True
+        t.start()
+    return ports
+
+def time_broadcast(manager, mode, count=200):
+    # Mean wall-clock time from starting a broadcast tick until every device has written it
+    packet = manager.all_devices.encoder.cached([BespeckleDevice.CMD_TICK])
+    for dev in manager.devices:
+        dev.write_inline = mode == "inline"
+    start = time.time()
+    for i in range(count):
+        if mode == "sequential":
+            # The old behaviour: one synchronous write after another
+            for dev in manager.devices:
+                dev.write(packet)
+        else:
+            manager.all_devices.tick()
+            manager.flush()
+    return (time.time() - start) / count
+
+def bench_broadcast():
+    print "{:<6} {:>4} {:>16} {:>16} {:>16}".format("ports", "N", "sequential (ms)", "queued (ms)", "inline (ms)")
+    for n in [1, 2, 4, 8, 15]:
+        for backend in ["pty", "fake"]:
+            if backend == "pty":
+                ports = open_pty_ports(n)
+                device_class = SingleBespeckleDevice
+            else:
+                ports = ["fake%d" % i for i in range(n)]
+                device_class = FakeSingleBespeckleDevice
+            manager = load_topology({}, dict(enumerate(ports)), device_class)
+            times = [time_broadcast(manager, mode) * 1000 for mode in ["sequential", "queued", "inline"]]
+            manager.close()
+            print "{:<6} {:>4} {:>16.3f} {:>16.3f} {:>16.3f}".format(backend, n, *times)
+
+def bench_scheduler(duration=5.0):
+    # Tick jitter and CPU use of each scheduler mode, at every frac and at every step
+    print "{:<9} {:>5} {:>7} {:>8} {:>13} {:>13}".format("mode", "res", "cpu", "skipped", "late p50 (ms)", "late p99 (ms)")
+    for resolution in [1, Timebase.step_fracs]:
+        for mode in TickScheduler.MODES:
+            tb = Timebase()
+            sched = TickScheduler(tb, lambda t: None, resolution=resolution, mode=mode)
+            sched.start()
+            time.sleep(duration)
+            sched.stop()
+            r = sched.report()
+            print "{:<9} {:>5} {:>6.1%} {:>8} {:>13.3f} {:>13.3f}".format(
+                    mode, resolution, r["cpu"], r["skipped"], r["late_p50"] * 1000, r["late_p99"] * 1000)
+
+def bench_simulator(steps=4000, strips=4):
+    # End-to-end: strobe channels -> devices -> simulated strips, as fast as they will go
+    from channels import StrobeChannel
+    from effects import RGBA
+    from simulator import SimulatedBespeckleDevice
+
+    ports = dict((i, "sim%d" % i) for i in range(strips))
+    manager = load_topology({"All": ports}, ports, SimulatedBespeckleDevice)
+    group = manager.default_group
+    colors = ["red", "green", "blue", "white"]
+    channels = [StrobeChannel(group, RGBA[c]) for c in colors]
+    rng = random.Random(0)
+    seq_len = Timebase.beats * Timebase.steps
+    data = [[rng.choice([0, 0, 1]) for i in range(seq_len)] for c in channels]
+    for channel in channels:
+        channel.start()
+
+    start = time.time()
+    for step in range(steps):
+        t = ((step // Timebase.steps) % Timebase.beats, (step % Timebase.steps) * Timebase.step_fracs)
+        for channel, d in zip(channels, data):
+            channel.tick(t, d[step % seq_len])
+            if channel.wake is not None:
+                # Let it turn off once its width is up, as the pattern engine would
+                channel.tick((t[0], t[1] + channel.wake), 0)
+        manager.tick(t)
+        manager.flush()
+    elapsed = time.time() - start
+    # Ticks outrank strobe messages on the wire; render once more to catch up
+    manager.all_devices.tick()
+    manager.flush()
+
+    # The last-added lit channel is on top
+    lit = [c for c, d in zip(colors, data) if d[(steps - 1) % seq_len]]
+    expected = RGBA[lit[-1]][0:3] if lit else [0, 0, 0]
+    for dev in manager.devices:
+        pixels = dev.snapshot()
+        assert (pixels[:, 0:3] == expected).all(), (pixels[0], expected)
+        assert dev.strip_decoder.errors == 0 and dev.unknown == 0
+    frames = sum(dev.strip_decoder.frames for dev in manager.devices)
+    manager.close()
+    print "{} strips: {:.0f} steps/sec, {:.0f} frames/sec decoded, output as expected".format(
+            strips, steps / elapsed, frames / elapsed)
+
+def bench_lookahead(duration=3.0, strips=3):
+    # When each strip renders its step, relative to the step's time on the beat
+    from simulator import SimulatedBespeckleDevice
+
+    class TimedDevice(SimulatedBespeckleDevice):
+        def execute(self, data):
+            if data[0] == self.CMD_TICK:
+                self.rendered.append(monotonic_ns())
+            SimulatedBespeckleDevice.execute(self, data)
+
+    print "{:>9} {:>6} {:>13} {:>15} {:>15}".format("lookahead", "strip", "latency (ms)", "offset p50 (ms)", "offset p99 (ms)")
+    for lookahead in [0, Timebase.step_fracs // 3]:
+        ports = dict((i, "sim%d" % i) for i in range(strips))
+        manager = load_topology({}, ports, TimedDevice, realtime=True)
+        for dev in manager.devices:
+            dev.rendered = []
+        tb = Timebase()
+        bus = TickBus(tb)
+        manager.set_tick_bus(bus, lookahead)
+        bus.start()
+        time.sleep(duration)
+        bus.stop()
+        manager.close()
+        for dev in manager.devices:
+            # Skip the first beat, while latency is still being measured
+            offsets = []
+            for t in dev.rendered[tb.steps:]:
+                step = (tb.position(t) + tb.step_fracs // 2) // tb.step_fracs * tb.step_fracs
+                offsets.append((t - tb.time_of(step)) / 1e9)
+            offsets.sort()
+            print "{:>9} {:>6} {:>13.3f} {:>15.3f} {:>15.3f}".format(lookahead, dev.name, dev.latency * 1000,
+                    offsets[len(offsets) // 2] * 1000, offsets[int(len(offsets) * 0.99)] * 1000)
+
+def legacy_tap_period(taps, t):
+    # The original `Timebase.tap`: mean spacing of (the first 5 of) the taps in the last 2 seconds
+    taps.append(t)
+    taps[:] = [tap for tap in taps if tap > t - 2][0:5]
+    diffs = [taps[i] - taps[i - 1] for i in range(1, len(taps))]
+    if diffs:
+        return sum(diffs) / len(diffs)
+    return None
+
+def tap_sequence(seed, bpm=120.0, taps=24, jitter=0.012, change_at=None, new_bpm=None, skip=(), extra=()):
+    # A performer's taps: (tap times, the true beat times and periods they were aiming for)
+    rng = random.Random(seed)
+    seq = []
+    t = 0.0
+    period = 60.0 / bpm
+    for i in range(taps):
+        if change_at is not None and i == change_at:
+            period = 60.0 / new_bpm
+        t += period
+        if i in skip:
+            continue
+        seq.append((t + rng.gauss(0, jitter), t, period))
+        if i in extra:
+            seq.append((t + period * rng.uniform(0.4, 0.6), t, period))
+    return seq
+
+TAP_SEQUENCES = [
+    ("steady 120", tap_sequence(0)),
+    ("sloppy 96", tap_sequence(1, bpm=96, jitter=0.025)),
+    ("stray tap", tap_sequence(2, extra=(8,))),
+    ("missed beat", tap_sequence(3, skip=(9,))),
+    ("120 -> 128", tap_sequence(4, change_at=12, new_bpm=128)),
+]
+
+def bench_taptempo(tolerance=1.0):
+    # The tap after which the tempo stays within `tolerance` BPM, and the errors over the last 4 taps
+    print "{:<12} {:<8} {:>9} {:>13} {:>14} {:>10}".format("sequence", "method", "settled", "bpm err (avg)", "phase err (ms)", "confidence")
+    for name, seq in TAP_SEQUENCES:
+        legacy_taps = []
+        tapper = TapTempo()
+        results = {"legacy": [], "tapper": []}
+        for t, beat, period in seq:
+            legacy = legacy_tap_period(legacy_taps, t)
+            tapper.tap(t)
+            true_bpm = 60.0 / period
+            results["legacy"].append((abs(60.0 / legacy - true_bpm) if legacy else None, None, None))
+            if tapper.period:
+                phase_err = abs(tapper.phase - beat)
+                phase_err = min(phase_err % period, period - phase_err % period)
+                results["tapper"].append((abs(60.0 / tapper.period - true_bpm), phase_err, tapper.confidence))
+            else:
+                results["tapper"].append((None, None, 0.0))
+        for method in ["legacy", "tapper"]:
+            errors = results[method]
+            converged = None
+            for i in range(len(errors) - 1, -1, -1):
+                if errors[i][0] is None or errors[i][0] > tolerance:
+                    break
+                converged = i + 1
+            steady = [e[0] for e in errors[-4:] if e[0] is not None]
+            phase = [e[1] for e in errors[-4:] if e[1] is not None]
+            print "{:<12} {:<8} {:>9} {:>13.2f} {:>14} {:>10}".format(name, method,
+                    "tap {}".format(converged) if converged else "never",
+                    sum(steady) / len(steady) if steady else float("nan"),
+                    "{:.1f}".format(sum(phase) / len(phase) * 1000) if phase else "-",
+                    "{:.2f}".format(errors[-1][2]) if errors[-1][2] is not None else "-")
+
+def synth_track(path, bpm, seconds=20.0, rate=44100, pattern="four", noise=0.05, seed=0):
+    # A WAV drum loop: kick on the beat, plus hats/snares depending on `pattern`
+    import wave
+    import numpy
+    rng = numpy.random.RandomState(seed)
+    n = int(seconds * rate)
+    out = rng.normal(0, noise, n)
+    period = 60.0 / bpm
+    t = numpy.arange(int(0.15 * rate)) / float(rate)
+    kick = numpy.sin(2 * numpy.pi * 60 * t * (1 + 2 * numpy.exp(-t * 40))) * numpy.exp(-t * 25)
+    hat = rng.normal(0, 0.3, len(t)) * numpy.exp(-t * 120)
+    snare = rng.normal(0, 0.5, len(t)) * numpy.exp(-t * 30)
+    def hit(sound, when):
+        i = int(when * rate)
+        if i < n:
+            out[i:i + len(sound)] += sound[:n - i]
+    first = 0.25
+    beat = 0
+    while first + beat * period < seconds:
+        start = first + beat * period
+        if pattern == "four" or beat % 4 in (0, 2) or pattern == "click":
+            hit(kick, start)
+        if pattern == "four":
+            hit(hat, start + period / 2)
+        elif pattern == "backbeat":
+            if beat % 2:
+                hit(snare, start)
+            hit(hat, start + period / 2)
+            if beat % 4 == 2:
+                hit(kick, start + period * 1.5)
+        beat += 1
+    w = wave.open(path, "wb")
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(rate)
+    w.writeframes((numpy.clip(out, -1, 1) * 32000).astype("<i2").tostring())
+    w.close()
+    return first, period
+
+TEST_TRACKS = [
+    ("click 120", 120.0, "click", 0.02),
+    ("house 128", 128.0, "four", 0.05),
+    ("rock 96", 96.0, "backbeat", 0.05),
+    ("dnb 174", 174.0, "four", 0.1),
+    ("noisy 110", 110.0, "backbeat", 0.2),
+]
+
+def bench_beatdetect(chunk=1024):
+    # Per-chunk processing time against the chunk's duration, and tempo/phase accuracy at the end of each track
+    import shutil
+    import tempfile
+    from beatdetect import detect_file
+    tmp = tempfile.mkdtemp()
+    print "{:<10} {:>8} {:>9} {:>13} {:>10} {:>15} {:>15}".format("track", "bpm", "detected", "phase (ms)", "confidence", "chunk p50 (ms)", "chunk max (ms)")
+    try:
+        for i, (name, bpm, pattern, noise) in enumerate(TEST_TRACKS):
+            path = os.path.join(tmp, "track%d.wav" % i)
+            first, period = synth_track(path, bpm, pattern=pattern, noise=noise, seed=i)
+            det, times = detect_file(path, chunk)
+            times.sort()
+            if det.period:
+                phase = (det.beat_time - first) % period
+                phase = min(phase, period - phase)
+                detected, phase = "{:.1f}".format(det.bpm), "{:.1f}".format(phase * 1000)
+            else:
+                detected, phase = "-", "-"
+            print "{:<10} {:>8.1f} {:>9} {:>13} {:>10.2f} {:>15.3f} {:>15.3f}".format(name, bpm, detected, phase,
+                    det.confidence, times[len(times) // 2] * 1000, times[-1] * 1000)
+    finally:
+        shutil.rmtree(tmp)
+    print "Each chunk is {:.1f}ms of audio".format(chunk * 1000.0 / 44100)
+
+def bench_resolution(duration=3.0, bpm=120.0, patterns=10, strips=4):
+    # The finest tick resolution the whole engine (timebase -> bus -> patterns -> devices) keeps up with
+    from channels import StrobeChannel
+    from effects import RGBA
+    from patterns import Pattern, PatternEngine
+
+    print "{:>10} {:>11} {:>8} {:>8} {:>13} {:>7}".format("fracs/step", "fracs/sec", "ticks", "skipped", "late p99 (ms)", "cpu")
+    original = Timebase.step_fracs
+    best = None
+    rng = random.Random(0)
+    try:
+        for step_fracs in [15, 30, 60, 120, 240, 480]:
+            Timebase.set_resolution(step_fracs)
+            ports = dict((i, "fake%d" % i) for i in range(strips))
+            manager = load_topology({}, ports, FakeSingleBespeckleDevice)
+            tb = Timebase()
+            tb.period = 60.0 / bpm
+            bus = TickBus(tb)
+            manager.set_tick_bus(bus, 0)
+            engine = PatternEngine()
+            pats = []
+            for i in range(patterns):
+                pattern = Pattern.new_template(manager)
+                for c, color in enumerate(["red", "green", "blue", "white"]):
+                    pattern.channels[c] = StrobeChannel(manager.default_group, RGBA[color])
+                    pattern.data[c] = [rng.choice([0, 0, 1]) for j in range(Pattern.SEQ_LEN)]
+                engine.add(pattern)
+                pattern.toggle()
+                pats.append(pattern)
+            bus.subscribe(engine.tick, TickBus.FRAC)
+            bus.start()
+            time.sleep(duration)
+            bus.stop()
+            for pattern in pats:
+                pattern.toggle()
+            manager.close()
+            r = bus.report()
+            rate = tb.fracs / tb.period
+            print "{:>10} {:>11.0f} {:>8} {:>8} {:>13.3f} {:>6.1%}".format(step_fracs, rate, r["ticks"], r["skipped"], r["late_p99"] * 1000, r["cpu"])
+            if r["skipped"] == 0:
+                best = (step_fracs, rate)
+    finally:
+        Timebase.set_resolution(original)
+    if best:
+        print "Highest sustained: {1:.0f} fracs/sec ({0} fracs per step) at {2:.0f} BPM".format(best[0], best[1], bpm)
+    else:
+        print "No resolution was sustained without skipping"
+
+class NullStrobeDevice(object):
+    # Just enough of a device group for `StrobeChannel`, counting the messages it would send
+    LANE_STROBE = BespeckleDevice.LANE_STROBE
+    def __init__(self):
+        self.messages = 0
+    def bespeckle_add_effect(self, effect_class, data=None, on_evict=None):
+        return 1
+    def bespeckle_msg_effect(self, bespeckle_id, data=None, lane=None):
+        self.messages += 1
+    def bespeckle_pop_effect(self, bespeckle_id):
+        pass
+
+def bench_patterns(counts=(10, 100, 200, 500), bars=2, seed=0):
+    # Per-frac cost of running N active patterns, ticking every channel vs. the engine's edge dispatch
+    from channels import StrobeChannel
+    from effects import RGBA
+    from patterns import Pattern, PatternEngine
+
+    rng = random.Random(seed)
+    ticks = [(i // Timebase.fracs, i % Timebase.fracs) for i in range(bars * Timebase.fracs)]
+    print "{:>8} {:>16} {:>12} {:>9} {:>11} {:>11} {:>15}".format(
+            "patterns", "per-pattern (us)", "engine (us)", "speedup", "msgs (pp)", "msgs (eng)", "no edges (us)")
+    for n in counts:
+        results = []
+        # The last run holds every channel steady, leaving only the engine's own per-tick cost
+        for engine, density in [(None, 0.2), (PatternEngine(), 0.2), (PatternEngine(), 0.0)]:
+            rng.seed(seed)
+            dev = NullStrobeDevice()
+            pats = []
+            for i in range(n):
+                pattern = Pattern.new_template(None)
+                for c in range(Pattern.CHANNELS):
+                    pattern.channels[c] = StrobeChannel(dev, RGBA["white"])
+                    pattern.data[c] = [int(rng.random() < density) for j in range(Pattern.SEQ_LEN)]
+                if engine is not None:
+                    engine.add(pattern)
+                pattern.toggle()
+                pats.append(pattern)
+            if engine is None:
+                def tick(t):
+                    for pattern in pats:
+                        pattern.tick(t)
+            else:
+                tick = engine.tick
+            start = time.time()
+            for t in ticks:
+                tick(t)
+            results.append(((time.time() - start) / len(ticks), dev.messages))
+            for pattern in pats:
+                pattern.toggle()
+        (legacy, legacy_msgs), (vector, vector_msgs), (steady, _) = results
+        print "{:>8} {:>16.1f} {:>12.1f} {:>8.1f}x {:>11} {:>11} {:>15.1f}".format(
+                n, legacy * 1e6, vector * 1e6, legacy / vector, legacy_msgs, vector_msgs, steady * 1e6)
+    print "{} fracs per step; a step at 120 BPM lasts {:.1f}ms".format(Timebase.step_fracs, 60000.0 / 120 / Timebase.steps)
+
+def bench_bank(count=5000, seed=0):
+    # Opening a show library: json of `Pattern.serialize` vs. the mmap'd bank
+    import json
+    import shutil
+    import tempfile
+    from bank import PatternBank, write_bank
+    from channels import StrobeChannel
+    from effects import RGBA
+    from patterns import Pattern
+
+    rng = random.Random(seed)
+    manager = load_topology({}, {0: "fake0"}, FakeSingleBespeckleDevice)
+    pats = []
+    for i in range(count):
+        pattern = Pattern(manager, name="Bank pattern %d" % i)
+        pattern.channels = [None] * Pattern.CHANNELS
+        for c, color in enumerate(["red", "green", "blue", "white"]):
+            pattern.channels[c] = StrobeChannel(manager.default_group, RGBA[color])
+            pattern.data[c] = [int(rng.random() < 0.2) for j in range(Pattern.SEQ_LEN)]
+        pats.append(pattern)
+    tmp = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(tmp, "bank.json")
+        bank_path = os.path.join(tmp, "bank.bin")
+        with open(json_path, "w") as f:
+            json.dump([p.serialize() for p in pats], f)
+        write_bank(bank_path, pats)
+
+        start = time.time()
+        with open(json_path) as f:
+            loaded = [Pattern.deserialize(d, manager) for d in json.load(f)]
+        json_open = time.time() - start
+        start = time.time()
+        bank = PatternBank(bank_path, manager)
+        bank_open = time.time() - start
+        start = time.time()
+        first = bank[count // 2]
+        bank_first = time.time() - start
+        start = time.time()
+        for i in range(len(bank)):
+            bank[i]
+        bank_all = time.time() - start
+
+        same = all((bank[i].data == pats[i].data).all() and bank[i].channels[3].describe() == pats[i].channels[3].describe()
+                   for i in range(count))
+        print "{} patterns, {} json, {} bank".format(count, format_bytes(os.path.getsize(json_path)), format_bytes(os.path.getsize(bank_path)))
+        print "{:<28} {:>10}".format("json load + deserialize", format_seconds(json_open))
+        print "{:<28} {:>10}".format("bank open", format_seconds(bank_open))
+        print "{:<28} {:>10}".format("bank first pattern", format_seconds(bank_first))
+        print "{:<28} {:>10}".format("bank every pattern", format_seconds(bank_all))
+        print "Round trip {}".format("matches" if same else "DIFFERS")
+        bank.close()
+    finally:
+        shutil.rmtree(tmp)
+        manager.close()
+
+def bench_library(count=2000, capacity=64, active=20, seed=0):
+    # Page switches through a large bank, and what the LRU keeps built while patterns come and go
+    import shutil
+    import tempfile
+    import urwid
+    from bank import PatternBank, write_bank
+    from channels import StrobeChannel
+    from cl import PatternGrid
+    from effects import RGBA
+    from patterns import Pattern, PatternEngine, PatternLibrary
+
+    class MainUI(object):
+        keypress_master = {}
+
+    rng = random.Random(seed)
+    manager = load_topology({}, {0: "fake0"}, FakeSingleBespeckleDevice)
+    pats = []
+    for i in range(count):
+        pattern = Pattern(manager, name="Lib %d" % i)
+        pattern.channels = [StrobeChannel(manager.default_group, RGBA["white"])] + [None] * (Pattern.CHANNELS - 1)
+        pattern.data[0] = [int(rng.random() < 0.3) for j in range(Pattern.SEQ_LEN)]
+        pats.append(pattern)
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "bank.bin")
+        write_bank(path, pats)
+        for pattern in pats:
+            Pattern.all_titles.discard(pattern.title)
+        library = PatternLibrary(manager, PatternBank(path, manager), PatternEngine(), capacity=capacity)
+        grid = PatternGrid(library, MainUI())
+        switch, render = [], []
+        # Held on to like the screen does with what it last drew; urwid only caches canvases still in use
+        canvas = None
+        for page in range(grid.pages):
+            start = time.time()
+            grid.set_page(page)
+            switch.append(time.time() - start)
+            start = time.time()
+            canvas = grid.base.render((160, 12))
+            render.append(time.time() - start)
+        # The once-a-beat refresh, with one pattern on the page toggled in between
+        beat = []
+        grid.set_page(0)
+        canvas = grid.base.render((160, 12))
+        for i in range(50):
+            if i % 4 == 0:
+                library[rng.randrange(grid.PAGE_SIZE)].toggle()
+            start = time.time()
+            grid.refresh()
+            canvas = grid.base.render((160, 12))
+            beat.append(time.time() - start)
+        switch.sort()
+        render.sort()
+        beat.sort()
+        print "{} patterns, {} pages: switch p50 {} max {}; redraw p50 {} (a frame at 60Hz is 16.7ms)".format(
+                count, grid.pages, format_seconds(switch[len(switch) // 2]), format_seconds(switch[-1]),
+                format_seconds(render[len(render) // 2]))
+        print "Beat refresh and redraw: p50 {} max {}".format(format_seconds(beat[len(beat) // 2]), format_seconds(beat[-1]))
+
+        start = time.time()
+        on = []
+        for i in rng.sample(range(count), 500):
+            library[i].toggle()
+            on.append(i)
+            if len(on) > active:
+                library[on.pop(0)].toggle()
+        elapsed = time.time() - start
+        stats = library.stats()
+        print "500 launches with {} kept running: {} per launch, {} built (capacity {}), {} evicted".format(
+                active, format_seconds(elapsed / 500), stats["built"], capacity, stats["evicted"])
+        edited = library[on[0]]
+        edited.data[1] = 1
+        for i in on:
+            library[i].toggle()
+        for i in rng.sample(range(count), 4 * capacity):
+            library[i]
+        print "Edits kept across eviction: {}".format(bool((library[on[0]].data[1] == 1).all()))
+    finally:
+        shutil.rmtree(tmp)
+        manager.close()
+
+def bench_launch(patterns=8, bpm=120.0):
+    # How late the first hits of patterns launched together reach the strip, relative to the bar
+    from channels import StrobeChannel
+    from effects import RGBA
+    from patterns import Pattern, PatternEngine
+    from simulator import SimulatedBespeckleDevice
+
+    class TimedDevice(SimulatedBespeckleDevice):
+        def execute(self, data):
+            if data[0] == self.CMD_MSG and list(data[2:6]) != RGBA["clear"]:
+                self.hits.append(monotonic_ns())
+            SimulatedBespeckleDevice.execute(self, data)
+
+    print "{:<10} {:>6} {:>15} {:>15}".format("launch", "hits", "first hit (ms)", "last hit (ms)")
+    for name in ["immediate", "quantized"]:
+        manager = load_topology({}, {0: "sim0"}, TimedDevice, realtime=True)
+        dev = manager.devices[0]
+        dev.hits = []
+        tb = Timebase()
+        tb.period = 60.0 / bpm
+        bus = TickBus(tb)
+        manager.set_tick_bus(bus, 0)
+        engine = PatternEngine()
+        pats = []
+        for i in range(patterns):
+            pattern = Pattern(manager, name="Launch %s %d" % (name, i))
+            pattern.channels = [StrobeChannel(manager.default_group, RGBA["white"]) for c in range(4)] + [None] * (Pattern.CHANNELS - 4)
+            pattern.data[0:4, 0] = 1
+            engine.add(pattern)
+            pats.append(pattern)
+        bars = []
+        def on_bar(tick):
+            bars.append(monotonic_ns())
+            if name == "immediate" and len(bars) == 2:
+                # Pressed right on the bar
+                for pattern in pats:
+                    pattern.toggle()
+        bus.subscribe(on_bar, TickBus.BAR)
+        bus.subscribe(engine.tick, TickBus.FRAC)
+        bus.start()
+        while len(bars) < 1:
+            time.sleep(0.01)
+        if name == "quantized":
+            time.sleep(tb.period)
+            for pattern in pats:
+                pattern.toggle(bus.fracs_in(TickBus.BAR))
+        while len(bars) < 3:
+            time.sleep(0.01)
+        bus.stop()
+        for pattern in pats:
+            if pattern.active:
+                pattern.toggle()
+        manager.close()
+        for pattern in pats:
+            Pattern.all_titles.discard(pattern.title)
+        hits = [(t - bars[1]) / 1e6 for t in dev.hits if bars[1] <= t < bars[2]]
+        print "{:<10} {:>6} {:>15.2f} {:>15.2f}".format(name, len(hits), min(hits), max(hits))
+    print "{} patterns x 4 strobe channels; a step at {:.0f} BPM lasts {:.1f}ms".format(patterns, bpm, 60000.0 / bpm / Timebase.steps)
+
+def bench_shadow(bars=16, strips=2, patterns=6, seed=0):
+    # Bytes a set puts on the wire with and without dropping redundant effect messages
+    import devices
+    from channels import StrobeChannel
+    from effects import RGBA, PulseColorEffect, StrobeColorEffect
+    from patterns import Pattern, PatternEngine
+    from simulator import SimulatedBespeckleDevice, SimulatedCanBus
+
+    print "{:<10} {:>10} {:>11} {:>13} {:>12}".format("suppress", "sent", "bytes", "suppressed", "bytes saved")
+    original = devices.SUPPRESS_REDUNDANT
+    states = []
+    try:
+        for suppress in [False, True]:
+            devices.SUPPRESS_REDUNDANT = suppress
+            rng = random.Random(seed)
+            ports = dict((i, "sim%d" % i) for i in range(strips))
+            manager = load_topology({"Stage": ports.keys()}, ports, SimulatedBespeckleDevice)
+            group = manager.default_group
+            canbus = SimulatedCanBus([group])
+            # effects.py ids stay clear of the allocator's, which hands out low ids first
+            effects = [StrobeColorEffect(canbus, [0], 200 + i, RGBA[color], rate=i + 1)
+                       for i, color in enumerate(["red", "blue", "magenta"])]
+            effects.append(PulseColorEffect(canbus, [0], 210, RGBA["cyan"]))
+            for effect in effects:
+                effect.start()
+                effect.started = True
+            engine = PatternEngine()
+            for i in range(patterns):
+                pattern = Pattern(manager, name="Set %d %d" % (suppress, i))
+                pattern.channels = [StrobeChannel(group, RGBA[c]) for c in ["red", "green", "blue", "white"]] + [None] * 4
+                for c in range(4):
+                    pattern.data[c] = [int(rng.random() < 0.25) for j in range(Pattern.SEQ_LEN)]
+                engine.add(pattern)
+                pattern.toggle()
+            for position in range(bars * Timebase.beats * Timebase.fracs):
+                t = Timebase.tick_of(position)
+                for effect in effects:
+                    effect.tick(t)
+                engine.tick(t)
+                if t[1] % Timebase.step_fracs == 0:
+                    manager.all_devices.tick()
+                    manager.flush()
+            manager.flush()
+            manager.close()
+            states.append([dict((i, e.__dict__.get("color", None).tolist() if hasattr(e, "color") else None)
+                                for i, e in dev.effects.items()) for dev in manager.devices])
+            sent = sum(dev.tx.sent for dev in manager.devices)
+            sent_bytes = sum(dev.bytes_sent for dev in manager.devices)
+            print "{:<10} {:>10} {:>11} {:>13} {:>12}".format(suppress, sent, format_bytes(sent_bytes), group.suppressed, format_bytes(group.bytes_saved))
+    finally:
+        devices.SUPPRESS_REDUNDANT = original
+    print "Strips end up the same: {}".format(states[0] == states[1])
+
+def bench_scenes(patterns=32, per_scene=8, switches=12, strips=2, seed=0):
+    # Packets and latency of changing the whole look: pattern by pattern vs. one scene switch
+    from channels import StrobeChannel
+    from effects import RGBA
+    from patterns import Pattern, PatternEngine, PatternLibrary
+    from scenes import Scene, SceneSwitcher
+
+    colors = ["red", "green", "blue", "white", "cyan", "magenta", "yellow"]
+    print "{:<10} {:>9} {:>8} {:>8} {:>10} {:>10} {:>12} {:>12}".format(
+            "switch", "packets", "adds", "stops", "handovers", "bytes", "apply (ms)", "wire (ms)")
+    for mode in ["toggles", "scene"]:
+        rng = random.Random(seed)
+        ports = dict((i, "fake%d" % i) for i in range(strips))
+        manager = load_topology({"Stage": ports.keys()}, ports, FakeSingleBespeckleDevice)
+        group = manager.default_group
+        library = PatternLibrary(manager, engine=PatternEngine())
+        for i in range(patterns):
+            pattern = Pattern(manager, name="Scene bench %s %d" % (mode, i))
+            pattern.channels = [StrobeChannel(group, RGBA[rng.choice(colors)]) for c in range(4)] + [None] * 4
+            for c in range(4):
+                pattern.data[c] = [int(rng.random() < 0.25) for j in range(Pattern.SEQ_LEN)]
+            library.append(pattern)
+        switcher = SceneSwitcher(library, library.engine, quantum=Timebase.beats * Timebase.fracs)
+        scenes = [switcher.add(Scene("Look %d" % n, rng.sample(range(patterns), per_scene),
+                                     dict((i, [{"color": RGBA[rng.choice(colors)]}] * 4) for i in range(patterns))))
+                  for n in range(switches)]
+
+        position = [0]
+        def run(fracs):
+            for i in range(fracs):
+                library.engine.tick(Timebase.tick_of(position[0]))
+                position[0] += 1
+        run(1)
+        packets, bytes_sent, adds, stops, handovers, apply_times, wire = 0, 0, 0, 0, 0, [], []
+        bar = Timebase.beats * Timebase.fracs
+        for scene in scenes:
+            run(bar // 2)
+            if mode == "scene":
+                record = switcher.switch(scene.name)
+            # Count only what goes out for the boundary the change lands on
+            run(bar - position[0] % bar)
+            manager.flush()
+            before = sum(dev.tx.sent for dev in manager.devices), sum(dev.bytes_sent for dev in manager.devices)
+            if mode == "scene":
+                run(1)
+                adds += record["adds"]
+                stops += record["stops"]
+                handovers += record["handovers"]
+                apply_times.append(record["apply_time"])
+            else:
+                # Press every pattern that has to change, one after the other
+                start = time.time()
+                targets = set(scene.patterns)
+                for i in range(patterns):
+                    pattern = library[i]
+                    if pattern.active != (i in targets):
+                        if pattern.active:
+                            stops += sum(1 for c in pattern.channels if c and c.started)
+                        else:
+                            adds += sum(1 for c in pattern.channels if c)
+                        pattern.toggle()
+                    if i in targets:
+                        for channel, desc in zip(pattern.channels, scene.channels[i]):
+                            channel.configure(desc)
+                apply_times.append(time.time() - start)
+                run(1)
+            manager.flush()
+            after = sum(dev.tx.sent for dev in manager.devices), sum(dev.bytes_sent for dev in manager.devices)
+            packets += after[0] - before[0]
+            bytes_sent += after[1] - before[1]
+            # 10 bits a byte on each strip's serial line
+            wire.append((after[1] - before[1]) * 10.0 / strips / BESPECKLE_BAUDRATE)
+        manager.close()
+        for i in range(patterns):
+            Pattern.all_titles.discard(library.title(i))
+        n = float(len(scenes))
+        print "{:<10} {:>9.1f} {:>8.1f} {:>8.1f} {:>10.1f} {:>10} {:>12.3f} {:>12.2f}".format(
+                mode, packets / n, adds / n, stops / n, handovers / n, format_bytes(int(bytes_sent / n)),
+                1000 * sum(apply_times) / n, 1000 * sum(wire) / n)
+    print "Per switch, averaged over {} switches between scenes of {} patterns ({} strobe channels each)".format(switches, per_scene, 4)
+
+def bench_offload(bars=8, strips=2, patterns=4, late=0.2, seed=0):
+    # Strip frames and wire load with every step sent from the host vs. the strips playing uploaded programs
+    from channels import StrobeChannel
+    from effects import RGBA
+    from patterns import Pattern, PatternEngine
+    from simulator import SimulatedBespeckleDevice
+
+    colors = ["red", "green", "blue", "white"]
+    print "{:<8} {:>6} {:>10} {:>10} {:>12} {:>14}".format("mode", "late", "sent", "bytes", "bytes/bar", "frames off")
+    reference = None
+    for offload, late_share in [(False, 0.0), (True, 0.0), (False, late), (True, late)]:
+        rng = random.Random(seed)
+        ports = dict((i, "sim%d" % i) for i in range(strips))
+        manager = load_topology({"Stage": ports.keys()}, ports, SimulatedBespeckleDevice)
+        group = manager.default_group
+        engine = PatternEngine()
+        built = []
+        for i in range(patterns):
+            pattern = Pattern(manager, name="Offload %d %s %d" % (offload, late_share, i))
+            pattern.channels = [StrobeChannel(group, RGBA[c]) for c in colors] + [None] * 4
+            for c in range(4):
+                pattern.data[c] = [int(rng.random() < 0.25) for j in range(Pattern.SEQ_LEN)]
+            pattern.offload = offload
+            engine.add(pattern)
+            pattern.toggle()
+            built.append(pattern)
+        manager.flush()
+        # The same stalls in both modes: the host's step work lands after the strips have ticked
+        stalls = random.Random(seed + 1)
+        frames = []
+        for position in range(bars * Timebase.beats * Timebase.fracs):
+            t = Timebase.tick_of(position)
+            if position == bars // 2 * Timebase.beats * Timebase.fracs:
+                # An edit halfway through
+                built[0].tap(0, 5)
+                built[1].tap(2, 12)
+            if t[1] % Timebase.step_fracs:
+                engine.tick(t)
+                continue
+            stalled = stalls.random() < late_share
+            if not stalled:
+                # On time: everything for the step is out before the strips tick
+                engine.tick(t)
+                manager.flush()
+            manager.tick(t)
+            manager.flush()
+            frames.append([dev.snapshot() for dev in manager.devices])
+            if stalled:
+                engine.tick(t)
+        manager.flush()
+        manager.close()
+        for pattern in built:
+            Pattern.all_titles.discard(pattern.title)
+        if reference is None:
+            reference = frames
+        off = sum(1 for a, b in zip(frames, reference) for x, y in zip(a, b) if (x != y).any())
+        sent = sum(dev.tx.sent for dev in manager.devices)
+        sent_bytes = sum(dev.bytes_sent for dev in manager.devices)
+        print "{:<8} {:>5.0%} {:>10} {:>10} {:>12} {:>8}/{:<5}".format(
+                "strip" if offload else "host", late_share, sent, format_bytes(sent_bytes),
+                format_bytes(sent_bytes // bars), off, len(frames) * strips)
+    print "Frames compared tick by tick with the host-driven run without stalls"
+
+def bench_catchup(duration=4.0, stall=0.15):
+    # Strobe hits and device ticks that make it out when a subscriber stalls the engine every beat
+    from channels import StrobeChannel
+    from effects import RGBA
+
+    class HitCounter(BespeckleDevice):
+        def __init__(self):
+            BespeckleDevice.__init__(self)
+            self.hits = 0
+            self.ticks = 0
+        def raw_packet(self, data, lane=BespeckleDevice.LANE_CONTROL, key=None, at=None):
+            pass
+        def tick(self, at=None):
+            self.ticks += 1
+        probe = tick
+        def bespeckle_msg_effect(self, bespeckle_id, data=None, lane=BespeckleDevice.LANE_PARAM):
+            if list(data[0:4]) != RGBA["clear"]:
+                self.hits += 1
+
+    seq_len = Timebase.beats * Timebase.steps
+    data = [0, 1, 0, 0] * (seq_len // 4) # One short hit every half beat, just after the stall
+    print "{:<6} {:>12} {:>12} {:>9} {:>8}".format("policy", "hits", "dev ticks", "replayed", "dropped")
+    for policy in TickBus.CATCH_UP:
+        dev = HitCounter()
+        channel = StrobeChannel(dev, RGBA["white"])
+        channel.start()
+        tb = Timebase()
+        bus = TickBus(tb, catch_up=policy)
+        manager = DeviceManager([])
+        manager.all_devices = dev
+        manager.set_tick_bus(bus, 0)
+        bus.subscribe(lambda t: channel.tick(t, data[Timebase.step_of(t)]), TickBus.FRAC)
+        bus.subscribe(lambda t: time.sleep(stall), TickBus.BEAT)
+        start = tb.position()
+        bus.start()
+        time.sleep(duration)
+        bus.stop()
+        steps = (tb.position() - start) // Timebase.step_fracs
+        print "{:<6} {:>5} / {:<4} {:>5} / {:<4} {:>9} {:>8}".format(policy, dev.hits, steps // 4, dev.ticks, steps, bus.replayed, bus.dropped)
+
+def ui_load(stop):
+    # Stand-in for urwid redraws and keyboard handling: pure-Python busy work holding the GIL
+    rows = [[random.randrange(2) for i in range(32)] for j in range(8)]
+    while not stop.is_set():
+        text = ["".join("#" if v else "." for v in row) for row in rows]
+        rows = [[1 - v for v in row] for row in rows]
+        "\n".join(text).split("\n")
+
+def bench_realtime(duration=4.0, load_threads=2, priority=50):
+    # Tick jitter under synthetic UI load, with the tick thread on the default scheduler and real-time
+    cpu = cpu_count() - 1
+    print "{:<9} {:>18} {:>8} {:>13} {:>13} {:>13}".format("mode", "applied", "skipped", "late p50 (ms)", "late p99 (ms)", "late max (ms)")
+    for name, kwargs in [("default", {}), ("realtime", {"cpu": cpu, "priority": priority})]:
+        stop = threading.Event()
+        loads = [threading.Thread(target=ui_load, args=(stop,)) for i in range(load_threads)]
+        for t in loads:
+            t.daemon = True
+            t.start()
+        sched = TickScheduler(Timebase(), lambda t: None, resolution=1, **kwargs)
+        sched.start()
+        time.sleep(duration)
+        sched.stop()
+        stop.set()
+        for t in loads:
+            t.join()
+        r = sched.report()
+        applied = r["realtime"] or {}
+        applied = ",".join("{}={}".format(k, v) for k, v in sorted(applied.items()) if v is not None) or "-"
+        print "{:<9} {:>18} {:>8} {:>13.3f} {:>13.3f} {:>13.3f}".format(name, applied, r["skipped"],
+                r["late_p50"] * 1000, r["late_p99"] * 1000, r["late_max"] * 1000)
+
+BENCHMARKS = {
+    "realtime": bench_realtime,
+    "catchup": bench_catchup,
+    "patterns": bench_patterns,
+    "resolution": bench_resolution,
+    "library": bench_library,
+    "launch": bench_launch,
+    "beatdetect": bench_beatdetect,
+    "bank": bench_bank,
+    "taptempo": bench_taptempo,
+    "lookahead": bench_lookahead,
+    "simulator": bench_simulator,
+    "offload": bench_offload,
+    "scenes": bench_scenes,
+    "scheduler": bench_scheduler,
+    "shadow": bench_shadow,
+    "broadcast": bench_broadcast,
+    "encoder": bench_encoder,
+}
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        print "== {} ==".format(name)
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
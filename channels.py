@@ -1,5 +1,6 @@
 import colorsys
 import logging
+import numpy
 import urwid
 
 from effects import *
@@ -19,6 +20,9 @@ class ChannelUI(object):
 
 class Channel(object):
     ui_class = ChannelUI
+    name = "Channel"
+    # Fracs until the channel next needs a tick even if its value stays the same; None if it doesn't
+    wake = None
 
     def __init__(self, device, *args, **kwargs):
         self.device = device
@@ -31,6 +35,23 @@ class Channel(object):
     def start(self):
         pass
 
+    @property
+    def started(self):
+        # True once `start` has allocated whatever the channel needs on the devices
+        return False
+
+    # Channels with equal keys can take over each other's started effect with
+    # `adopt(other)`, which returns the messages it sent; None if they can't
+    effect_key = None
+
+    def configure(self, description):
+        # Apply the settings in a `describe` dict of the same type
+        pass
+
+    def program(self, steps):
+        # This channel playing `steps` as a program for the strips' sequencer effect (see `Pattern.offload`), or None if it can't
+        return None
+
     def tick(self, time, value):
         beat, tick = time
 
@@ -40,6 +61,10 @@ class Channel(object):
     def keyboard_event(self, event):
         kid, ev, pressed = event
 
+    def describe(self):
+        # Plain data to rebuild the channel with `make_channel`
+        return {"type": self.name}
+
     def update(self):
         if self.ui is not None:
             self.ui.update()
@@ -67,30 +92,111 @@ class StrobeChannel(Channel):
     ui_class = StrobeChannelUI
     name = "Strobe"
 
-    def init(self, color_rgba=RGBA["white"], width=10):
+    def init(self, color_rgba=RGBA["white"], width=None):
+        # `width` - fracs to stay on after the last lit step; a third of a step by default
+        if width is None:
+            width = Timebase.step_fracs // 3
         self.color_rgba = color_rgba
         self.bespeckle_id = None
         self.last_on = None
+        self.released = None
         self.width = width
 
     def start(self):
         data = []
-        self.bespeckle_id = self.device.bespeckle_add_effect(self.bespeckle_effect_class, data)
+        self.bespeckle_id = self.device.bespeckle_add_effect(self.bespeckle_effect_class, data, on_evict=self.evicted)
+
+    def evicted(self, bespeckle_id):
+        # The device gave our id to a newer effect: forget it without stopping anything
+        if self.bespeckle_id == bespeckle_id:
+            self.bespeckle_id = None
+            self.last_on = self.released = None
+            self.wake = None
+
+    @property
+    def started(self):
+        return self.bespeckle_id is not None
+
+    @property
+    def effect_key(self):
+        return (self.device, self.bespeckle_effect_class)
+
+    def adopt(self, other):
+        self.bespeckle_id, other.bespeckle_id = other.bespeckle_id, None
+        self.device.effect_ids.own(self.bespeckle_id, self.evicted)
+        self.last_on = self.released = None
+        self.wake = None
+        if other.last_on is None:
+            return 0
+        # Start from dark, as a fresh effect would
+        other.last_on = other.released = None
+        other.wake = None
+        self.device.bespeckle_msg_effect(self.bespeckle_id, RGBA["clear"] + [0xff, 0x0], lane=self.device.LANE_STROBE)
+        return 1
+
+    def configure(self, description):
+        if "color" in description:
+            self.color_rgba = list(description["color"])
+        if "width" in description:
+            self.width = description["width"]
 
     def tick(self, time, value):
         beat, tick = time
-        if self.bespeckle_id is None:
+        # Read once: a stop or eviction on another thread may clear it
+        bespeckle_id = self.bespeckle_id
+        if bespeckle_id is None:
             return 
         if value:
             if self.last_on is None:
-                self.device.bespeckle_msg_effect(self.bespeckle_id, self.color_rgba + [self.width, 0]) #[tick, tick+self.width])
+                self.device.bespeckle_msg_effect(bespeckle_id, self.color_rgba + [min(self.width, 0xff), 0], lane=self.device.LANE_STROBE) #[tick, tick+self.width])
             self.last_on = time
-        elif self.last_on is not None and Timebase.difference(self.last_on, time) > self.width:
-            self.device.bespeckle_msg_effect(self.bespeckle_id, RGBA["clear"] + [0xff, 0x0])
-            self.last_on = None
+            self.released = None
+            self.wake = None
+        elif self.last_on is not None:
+            if self.released is None:
+                self.released = time
+            left = self.width - Timebase.difference(self.released, time)
+            if left > 0:
+                self.wake = left
+            else:
+                self.device.bespeckle_msg_effect(bespeckle_id, RGBA["clear"] + [0xff, 0x0], lane=self.device.LANE_STROBE)
+                self.last_on = None
+                self.released = None
+                self.wake = None
+
+    def program(self, steps):
+        """
+        [color (4), hold, length, steps (1 bit each, most significant first)].
+        The strip only changes on ticks, so `width` rounds up to whole steps
+        to hold after each run of lit steps.
+        """
+        hold = min(-(-self.width // Timebase.step_fracs), 0xff)
+        return list(self.color_rgba) + [hold, len(steps)] + numpy.packbits(numpy.asarray(steps) != 0).tolist()
 
     def stop(self):
         if self.bespeckle_id is not None:
             self.device.bespeckle_pop_effect(self.bespeckle_id)
             self.bespeckle_id = None
+        self.last_on = self.released = None
+        self.wake = None
+
+    def describe(self):
+        return {"type": self.name, "color": list(self.color_rgba), "width": self.width}
+
+CHANNEL_TYPES = [StrobeChannel]
+
+def make_channel(device, description):
+    # Inverse of `Channel.describe`
+    if description is None:
+        return None
+    kwargs = dict(description)
+    name = kwargs.pop("type")
+    for cls in CHANNEL_TYPES:
+        if cls.name == name:
+            break
+    else:
+        raise Exception("Unknown channel type %s" % name)
+    if "color" in kwargs:
+        kwargs["color_rgba"] = list(kwargs.pop("color"))
+    return cls(device, **kwargs)
 
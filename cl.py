@@ -1,8 +1,8 @@
 import Queue
 import collections
-import copy
 import evdev
 import logging
+import subprocess
 import sys
 import threading
 import traceback
@@ -10,12 +10,18 @@ import urwid
 
 from evdev import ecodes as E
 
+from bank import PatternBank
+from beatdetect import BeatTracker
 from channels import *
 from config import *
 from devices import *
 from effects import *
 from inputs import *
+from patterns import *
+from scenes import Scene, SceneSwitcher
+from stats import *
 from timing import *
+from wire import WireRecorder
 
 
 logging.basicConfig(filename="/tmp/cl.log", level=logging.DEBUG)
@@ -93,91 +99,6 @@ class CANDeviceGroupUI(object):
         for w in [self.dev_group, self.options, self.effects]:
             self.pile.contents.append((w, self.pile.options()))
 
-class Pattern(object):
-    SEQ_LEN = 32
-    CHANNELS = 8
-    all_titles = set()
-    def __init__(self, device_manager, name=None):
-        self.device_manager = device_manager
-        self.data = [([0] * self.SEQ_LEN) for i in range(self.CHANNELS)]
-        self.channels = [[]  for i in range(self.CHANNELS)]
-        self.channels_muted = [False] * self.CHANNELS
-        self.speed = 1
-        self.active = False
-        self.keybinding = (None, None)
-
-        if name is None:
-            name = "Pattern #%d" % (len(self.all_titles) + 1)
-        while name in self.all_titles:
-            name += "_"
-        self.all_titles.add(name)
-        self.title = name
-
-    def get_channel_description(self, i):
-        channel = self.channels[i]
-        return "Channel %d: %s" % (i+1, str(channel)) #TODO
-
-    def tap(self, channel, beat, width=1, keyboard=True):
-        # User input to change pattern @ (channel, beat)
-        v = self.data[channel][beat]
-        self.data[channel][beat] = 1 - v
-
-    def toggle(self):
-        self.active = not self.active
-        if self.active:
-            for channel in self.channels:
-                if channel is not None:
-                    channel.start()
-                    debug("STARTED")
-        else:
-            for channel in self.channels:
-                if channel is not None:
-                    channel.stop()
-
-    def tick(self, time):
-        beat, tick = time
-        step = Timebase.scale(time, self.SEQ_LEN)
-        for channel, data in zip(self.channels, self.data):
-            if channel is not None:
-                #debug(data[step])
-                channel.tick(time, data[step])
-
-    def serialize(self):
-        return {
-            "data": self.data,
-            "channels": self.channels,
-            "title": self.title,
-            "_seqlen": self.SEQ_LEN,
-            "_channels": self.CHANNELS
-        }
-    @classmethod
-    def deserialize(cls, d):
-        # Maybe there should be more checks. Don't mess around too much
-        if d["_seqlen"] != cls.SEQ_LEN:
-            raise Exception("Unable to deseri1alize pattern; mismatched seqlen (should be %d)" % self.SEQ_LEN)
-        if d["_channels"] != cls.CHANNELS:
-            raise Exception("Unable to deserialize pattern; mismatched channels (should be %d)" % self.CHANNELS)
-        p = cls(name=d["title"])
-        p.data = copy.deepcopy(d["data"])
-        p.channels = copy.deepcopy(d["channels"])
-        return p
-
-    @classmethod
-    def new_template(cls, device_manager):
-        p = cls(device_manager, name="New Pattern")
-        p.data = [[0] * 32 for i in range(8)]
-        p.channels = [None] * 8
-        return p
-
-EXAMPLE_PATTERN_SERIALIZED = {
-    #"data": [[1,0,0,0] * 8, [1,0] * 16, [0,0,1,0,0,1,0,1] * 4] + [[0] * 32 for i in range(5)],
-    "data": [[0] * 32 for i in range(8)],
-    "channels": ["Ch"] * 8,
-    "title": "Ex. Pattern",
-    "_seqlen": Pattern.SEQ_LEN,
-    "_channels": Pattern.CHANNELS
-}
-
 class PatternText(urwid.WidgetWrap):
     def __init__(self, pattern=None, index=None, data=None):
         if data is not None:
@@ -259,6 +180,7 @@ class SequencingGrid(object):
     KEY_BLACK = E.KEY_APOSTROPHE
     KEY_MORE = E.KEY_BACKSLASH
     KEY_LESS = E.KEY_BACKSPACE
+    KEY_OFFLOAD = E.KEY_SLASH
 
     KEYS_COLORS = {
         KEY_RED: "red",
@@ -272,7 +194,6 @@ class SequencingGrid(object):
     }
 
     # Unused:
-    #E.KEY_SLASH
     #E.KEY_ENTER
     
     def __init__(self, mainui): 
@@ -294,6 +215,7 @@ class SequencingGrid(object):
         def grid_clear_click(btn, user_data):
             if self.pattern is not None:
                 self.pattern.data[user_data] = [0] * Pattern.SEQ_LEN
+                self.pattern.upload()
                 self.grid_texts[user_data].update()
 
         for i in range(Pattern.CHANNELS):
@@ -319,7 +241,11 @@ class SequencingGrid(object):
         self.speed_btns = []
         for sp in [1, 2, 4]:
             urwid.RadioButton(self.speed_btns, "%dx Speed" % sp, user_data=sp)
-        self.details = urwid.Pile([self.title] + self.speed_btns)
+        def offload_change(box, state):
+            if self.pattern is not None:
+                self.pattern.set_offload(state)
+        self.offload = urwid.CheckBox("Strips play it", on_state_change=offload_change)
+        self.details = urwid.Pile([self.title] + self.speed_btns + [self.offload])
         self.content = urwid.Columns([('weight', 3, self.grid), ('weight', 1, self.details)])
         self.base = urwid.AttrMap(urwid.LineBox(self.content), 'inactive_window')
 
@@ -337,8 +263,7 @@ class SequencingGrid(object):
             self.grid_marks[i].set_text(m)
 
         if time is not None:
-            beat, tick = time
-            self.time_idx = beat * 8 + (tick / 30)
+            self.time_idx = Timebase.step_of(time)
 
         time_text = []
         for i in range(Pattern.SEQ_LEN):
@@ -371,6 +296,7 @@ class SequencingGrid(object):
             self.grid_descs[i].set_text(pattern.get_channel_description(i))
             self.grid_mutes[i].set_state(pattern.channels_muted[i], do_callback=False)
         self.title.set_edit_text(pattern.title)
+        self.offload.set_state(pattern.offload, do_callback=False)
         for sbtn in self.speed_btns:
             if False and pattern.speed == sbtn.user_data:
                 sbtn.toggle_state()
@@ -400,32 +326,52 @@ class SequencingGrid(object):
                         elif self.KEY_LESS in pressed:
                             color_rgba = rgb_add(channel.color_rgba, color_rgba, neg=True)
                         channel.color_rgba = color_rgba
+                        self.pattern.upload()
+                elif ev.code == self.KEY_OFFLOAD:
+                    self.pattern.set_offload(not self.pattern.offload)
+                    self.load_pattern()
                 elif ev.code in self.KEYS_CHANNELS:
                     self.channel_active = self.channel_offset + self.KEYS_CHANNELS[ev.code] - 1
 
 
 class PatternButton(urwid.WidgetWrap):
-    def __init__(self, pattern, mainui):
-        self.pattern = pattern
+    # Shows library entry `index` without building the pattern until it is pressed or edited
+    def __init__(self, library, index, mainui, hotkey=None):
+        self.library = library
+        self.index = index
         self.mainui = mainui
+        self.hotkey = hotkey
 
         self.content = urwid.Text('') 
         self.box = urwid.LineBox(urwid.Padding(self.content))
         super(PatternButton, self).__init__(urwid.AttrMap(self.box, 'inactive_btn'))
+        # (title, attr) last drawn; urwid redraws whatever is set, changed or not
+        self.shown = None
         self.refresh()
 
+    @property
+    def pattern(self):
+        if self.index is None:
+            return None
+        return self.library[self.index]
+
     def refresh(self):
-        if self.pattern is None:
-            self.content.set_text("New Pattern")
-            self._w.set_attr_map({None: 'new_btn'})
-            self.keybinding = (E.KEY_INSERT, None)
+        if self.index is None:
+            shown = ("New Pattern", 'new_btn')
         else:
-            self.content.set_text(self.pattern.title)
-            if self.pattern.active:
-                self._w.set_attr_map({None: 'active_btn'})
-            else:
-                self._w.set_attr_map({None: 'inactive_btn'})
-            self.keybinding = self.pattern.keybinding
+            title = self.library.title(self.index)
+            if self.library.is_pending(self.index):
+                title = "~" + title
+            if self.hotkey is not None:
+                title = "%s %s" % (PatternGrid.HOTKEY_DICT[self.hotkey], title)
+            shown = (title, 'active_btn' if self.library.is_active(self.index) else 'inactive_btn')
+        if shown == self.shown:
+            return
+        if self.shown is None or shown[0] != self.shown[0]:
+            self.content.set_text(shown[0])
+        if self.shown is None or shown[1] != self.shown[1]:
+            self._w.set_attr_map({None: shown[1]})
+        self.shown = shown
 
     def mouse_event(self, size, event, button, col, row, focus):
         if event == "mouse press":
@@ -441,14 +387,16 @@ class PatternButton(urwid.WidgetWrap):
         return False
 
     def press(self):
-        if self.pattern is not None:
-            self.pattern.toggle()
+        if self.index is not None:
+            self.pattern.toggle(self.mainui.launch_quantum)
         else:
-            pass
+            self.mainui.patgrid.new()
+            return
         self.refresh()
 
     def edit(self):
-        self.mainui.seqgrid.load_pattern(self.pattern)
+        if self.index is not None:
+            self.mainui.edit_pattern(self.index)
         
 
 class PatternGrid(object):
@@ -464,44 +412,111 @@ class PatternGrid(object):
 
     HOTKEY_DICT = dict(zip(HOTKEYS, HOTKEY_NAMES))
 
-    def __init__(self, patterns, mainui):
-        self.patterns = patterns
+    KEY_PAGE_PREV = E.KEY_PAGEUP
+    KEY_PAGE_NEXT = E.KEY_PAGEDOWN
+    PAGE_SIZE = len(HOTKEYS)
+
+    def __init__(self, library, mainui):
+        self.library = library
         self.mainui = mainui
+        self.page = 0
 
         self.new_pattern = urwid.LineBox(urwid.Padding(urwid.Text("New")))
+        self.page_text = urwid.Text('', align='right')
         self.content = urwid.GridFlow([], 16, 1, 1, 'center')
-        self.base = urwid.AttrMap(urwid.LineBox(urwid.Filler(self.content)), 'inactive_window')
+        self.base = urwid.AttrMap(urwid.LineBox(urwid.Filler(urwid.Pile([('pack', self.page_text), self.content]), valign='top')), 'inactive_window')
 
+        self.buttons = [self.make_button(None, hotkey) for hotkey in self.HOTKEYS]
+        self.new_button = self.make_new_button()
         self.rebuild_buttons()
     
-    def make_button(self, pattern):
-        #box = urwid.LineBox(urwid.Padding(urwid.Text(pattern.title)))
-        #return urwid.AttrMap(box, 'active_btn' if pattern.active else 'inactive_btn')
-        return PatternButton(pattern, self.mainui)
+    @property
+    def pages(self):
+        # The last page always has room for the new pattern button
+        return len(self.library) // self.PAGE_SIZE + 1
+
+    def make_button(self, index, hotkey=None):
+        return PatternButton(self.library, index, self.mainui, hotkey)
 
     def make_new_button(self):
-        #box = urwid.LineBox(urwid.Padding(urwid.Text("New")))
-        #return urwid.AttrMap(box, 'new_btn')
-        return PatternButton(None, self.mainui)
+        return PatternButton(self.library, None, self.mainui)
 
     def rebuild_buttons(self):
+        # The buttons are reused and only read titles, so a page switch costs the same however big the library is
         btns = []
-        for pattern in self.patterns:
-            btns.append((self.make_button(pattern), self.content.options()))
-        btns.append((self.make_new_button(), self.content.options()))
-        self.content.contents = btns
+        for btn, index in zip(self.buttons, self.library.page(self.page, self.PAGE_SIZE)):
+            btn.index = index
+            btn.refresh()
+            btns.append((btn, self.content.options()))
+        if self.page == self.pages - 1:
+            btns.append((self.new_button, self.content.options()))
+        if [btn for btn, options in btns] != [btn for btn, options in self.content.contents]:
+            # Setting the contents rebuilds the whole grid
+            self.content.contents = btns
+        self.page_text.set_text("Page %d/%d" % (self.page + 1, self.pages))
+
+    def set_page(self, page):
+        self.page = max(0, min(page, self.pages - 1))
+        self.rebuild_buttons()
+
+    def refresh(self):
+        for btn, options in self.content.contents:
+            btn.refresh()
+
+    def new(self):
+        pattern = Pattern.new_template(self.library.device_manager)
+        index = self.library.append(pattern)
+        self.set_page(index // self.PAGE_SIZE)
 
     def keyboard_event(self, event, mode=False):
         kid, ev, pressed = event
         if mode:
             if ev.value == 0: #Key Up
-                pass
+                if ev.code == self.KEY_PAGE_PREV:
+                    self.set_page(self.page - 1)
+                elif ev.code == self.KEY_PAGE_NEXT:
+                    self.set_page(self.page + 1)
+                elif ev.code in self.HOTKEYS and ev.code not in self.mainui.keypress_master:
+                    index = self.page * self.PAGE_SIZE + self.HOTKEYS.index(ev.code)
+                    if index < len(self.library):
+                        self.library[index].toggle(self.mainui.launch_quantum)
+                        self.refresh()
 
 class SettingsBox(object):
     def __init__(self, mainui):
         self.mainui = mainui
-        self.content = urwid.Pile([])
-        self.base = urwid.AttrMap(urwid.LineBox(self.content), 'inactive_window')
+        self.device_stats = urwid.Text('')
+        self.content = urwid.Pile([self.device_stats])
+        self.base = urwid.AttrMap(urwid.LineBox(urwid.Filler(self.content, valign='top')), 'inactive_window')
+
+    def update_stats(self, device_manager):
+        lines = ["Ticks skipped: %d" % device_manager.skipped]
+        suppressed, saved = device_manager.suppressed
+        lines.append("Suppressed %d (%s saved)" % (suppressed, format_bytes(saved)))
+        switch = self.mainui.scenes.last()
+        if switch is not None:
+            lines.append("%s in %s: adds %d stops %d handed over %d msgs %d" % (switch["scene"], format_seconds(switch["latency"]),
+                switch["adds"], switch["stops"], switch["handovers"], switch["msgs"]))
+        if device_manager.bus is not None:
+            lines.append("Steps replayed %d dropped %d" % (device_manager.bus.replayed, device_manager.bus.dropped))
+        for dev in device_manager.devices:
+            tx = dev.tx
+            lines += [
+                "",
+                str(dev.name),
+                " sent %d (%s)" % (tx.sent, format_bytes(dev.bytes_sent)),
+                " write p50 %s p99 %s" % (format_seconds(dev.write_latency.percentile(0.5)), format_seconds(dev.write_latency.percentile(0.99))),
+                " queue %d (max %d) wait p99 %s" % (len(tx), tx.max_depth, format_seconds(tx.waits.percentile(0.99))),
+                " late %d shed %d coalesced %d" % (tx.late, tx.shed, tx.coalesced),
+                " rtt p50 %s lost %d%s%s" % (format_seconds(dev.rtt.percentile(0.5)), dev.lost,
+                    " BEHIND" if dev.behind else "", " rebooted %d" % dev.reboots if dev.reboots else ""),
+            ]
+        lines.append("")
+        for group in device_manager.groups.values():
+            ids = group.effect_ids
+            lines.append("%s: ids %d/%d (peak %d)" % (group.name, len(ids), ids.size, ids.peak))
+        self.device_stats.set_text("\n".join(lines))
+
     def keyboard_event(self, event, mode=False):
         kid, ev, pressed = event
 
@@ -530,14 +545,17 @@ class CursedLightUI(object):
 
     def __init__(self, keyboards, device_manager):
         self.tb = Timebase()
+        self.bus = TickBus(self.tb, mode=TICK_SCHEDULER, catch_up=CATCH_UP, cpu=REALTIME_CPU, priority=REALTIME_PRIORITY)
+        self.ui_ticks = Queue.Queue()
         self.keyboards = keyboards
         #self.effects_runner = effects_runner
         self.device_manager = device_manager
         self.running = True
-        self.device_manager.set_timebase(self.tb)
+        self.device_manager.set_tick_bus(self.bus)
+        self.audio = None
+        self.beat_tracker = None
 
         self.mode = self.MODE_PAT
-        self.last_tick = (0, 0)
 
         evloop = CustomSelectEventLoop()
         evloop.custom_function = lambda: self.idle_loop()
@@ -554,15 +572,24 @@ class CursedLightUI(object):
         self.footer = urwid.Columns([])
         self.center = urwid.Pile([])
 
-        self.patterns = [Pattern.new_template(self.device_manager) for i in range(10)]
-        self.patterns[0].channels[0] = StrobeChannel(self.device_manager.devices[0], RGBA["red"])
-        self.patterns[0].channels[1] = StrobeChannel(self.device_manager.devices[0], RGBA["green"])
-        self.patterns[0].channels[2] = StrobeChannel(self.device_manager.devices[0], RGBA["blue"])
-        self.patterns[0].channels[3] = StrobeChannel(self.device_manager.devices[0], RGBA["white"])
+        self.engine = PatternEngine()
+        bank = PatternBank(PATTERN_BANK, self.device_manager) if PATTERN_BANK else None
+        self.library = PatternLibrary(self.device_manager, bank, self.engine, capacity=PATTERN_CACHE)
+        if bank is None:
+            group = self.device_manager.default_group
+            for i in range(10):
+                self.library.append(Pattern.new_template(self.device_manager))
+            self.library[0].channels[0] = StrobeChannel(group, RGBA["red"])
+            self.library[0].channels[1] = StrobeChannel(group, RGBA["green"])
+            self.library[0].channels[2] = StrobeChannel(group, RGBA["blue"])
+            self.library[0].channels[3] = StrobeChannel(group, RGBA["white"])
 
         self.seqgrid = SequencingGrid(self)
-        self.seqgrid.load_pattern(self.patterns[0])
-        self.patgrid = PatternGrid(self.patterns, self)
+        # Library index of the pattern in the sequencing grid, pinned so it is never evicted
+        self.editing = None
+        if len(self.library):
+            self.edit_pattern(0)
+        self.patgrid = PatternGrid(self.library, self)
         self.settings = SettingsBox(self)
         
         self.toggle_mode(new_mode=self.MODE_PAT)
@@ -574,7 +601,7 @@ class CursedLightUI(object):
 
         self.status = urwid.Text(('status', 'CursedLight - Debug'), align='left')
         self.keyboard_status = urwid.Text(('status', 'Keyboard Free'), align='center')
-        self.device_status = urwid.Text(('status', 'Devices'), align='right')
+        self.device_status = urwid.Text(('status', 'Devices: %d' % len(self.device_manager.devices)), align='right')
         self.bpm = urwid.Text("", align='left')
         self.ticker = urwid.Text("", align='right')
 
@@ -590,12 +617,33 @@ class CursedLightUI(object):
             #E.KEY_G: lambda ev: self.tb.multiply(2),
             #E.KEY_H: lambda ev: self.tb.multiply(0.5),
             E.KEY_DELETE: lambda ev: self.stop(),
+            E.KEY_SCROLLLOCK: lambda ev: self.device_manager.force_resync(),
+            E.KEY_KP1: lambda ev: self.scene_key(1),
+            E.KEY_KP2: lambda ev: self.scene_key(2),
+            E.KEY_KP3: lambda ev: self.scene_key(3),
+            E.KEY_KP4: lambda ev: self.scene_key(4),
+            E.KEY_KP5: lambda ev: self.scene_key(5),
+            E.KEY_KP6: lambda ev: self.scene_key(6),
+            E.KEY_KP7: lambda ev: self.scene_key(7),
+            E.KEY_KP8: lambda ev: self.scene_key(8),
+            E.KEY_KP9: lambda ev: self.scene_key(9),
             #E.KEY_R: lambda ev: self.tb.sync(ev.timestamp()),
             #E.KEY_T: lambda ev: self.tb.tap(ev.timestamp()),
             #E.KEY_F: lambda ev: self.tb.nudge(1),
             #E.KEY_D: lambda ev: self.tb.nudge(-1),
         }
 
+        # Patterns run on the bus thread; anything touching widgets goes through `ui_ticks`
+        self.bus.subscribe(self.engine.tick, TickBus.FRAC, lead=LOOKAHEAD_FRACS)
+        self.launch_quantum = self.bus.fracs_in(LAUNCH_QUANTIZE) * LAUNCH_MULTIPLE if LAUNCH_QUANTIZE else None
+        self.scenes = SceneSwitcher(self.library, self.engine, self.launch_quantum)
+        if SCENE_FILE:
+            self.scenes.load(SCENE_FILE)
+        self.bus.subscribe(self.update_ticker, TickBus.FRAC, queue=self.ui_ticks)
+        self.bus.subscribe(self.seqgrid.update_marks, TickBus.STEP, queue=self.ui_ticks)
+        self.bus.subscribe(self.beat, TickBus.BEAT, queue=self.ui_ticks)
+        self.bus.start()
+
         global debug
         debug = lambda s: self.debug(s)
 
@@ -664,17 +712,13 @@ class CursedLightUI(object):
         self.loop.run()
 
     def idle_loop(self):
-        tick = self.tb.tick()
-        for pattern in self.patterns:
-            pattern.tick(tick)
-        self.seqgrid.update_marks(time=tick)
-        self.ticker.set_text([('bpm_text', 'Tick: '), ('bpm', '{0}.{1:03d}'.format(*tick))])
-        self.bpm.set_text([('bpm_text', 'BPM: '), ('bpm', '{: <6.01f}'.format(self.tb.bpm))])
-        if tick[1] < 10:
-            self.keyboards.set_all_leds(caps=tick[0] == 0)
-
-        #self.device_manager.tick(tick)
-        debug("Fracs skipped: %s" % (self.device_manager.skipped) )
+        while not self.ui_ticks.empty():
+            try:
+                callback, args = self.ui_ticks.get_nowait()
+            except Queue.Empty:
+                pass
+            else:
+                callback(*args)
 
         while not self.keyboards.events.empty():
             try:
@@ -688,15 +732,57 @@ class CursedLightUI(object):
                 for ev_handler in self.kbd_event_handlers[kid]:
                     ev_handler(event)
 
-        self.last_tick = tick
+    def update_ticker(self, tick):
+        self.ticker.set_text([('bpm_text', 'Tick: '), ('bpm', '{0}.{1:03d}'.format(*tick))])
+        self.bpm.set_text([('bpm_text', 'BPM: '), ('bpm', '{: <6.01f}'.format(self.tb.bpm))])
+
+    def edit_pattern(self, index):
+        # Unpins only what was being edited; anything else stays pinned
+        if self.editing is not None:
+            self.library.pinned.discard(self.editing)
+        self.editing = index
+        self.library.pinned.add(index)
+        self.seqgrid.load_pattern(self.library[index])
+
+    def beat(self, tick):
+        self.keyboards.set_all_leds(caps=tick[0] == 0)
+        # Once a beat is plenty
+        self.settings.update_stats(self.device_manager)
+        # Quantized launches land on beats
+        self.patgrid.refresh()
+
+    def scene_key(self, n):
+        # Numpad slots: switch to scene `n`, or save what is running as scene `n` if there is none yet
+        name = "Scene %d" % n
+        if name in self.scenes.scenes:
+            self.scenes.switch(name)
+        else:
+            self.scenes.add(Scene.capture(name, self.library))
+            if SCENE_FILE:
+                self.scenes.save(SCENE_FILE)
 
     def stop(self):
         raise urwid.ExitMainLoop()
 
+    def listen(self, command, latency=0.0):
+        # Keep the timebase locked to the beat of the audio `command` outputs
+        self.audio = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+        self.beat_tracker = BeatTracker(self.tb, self.audio.stdout, latency=latency)
+        self.beat_tracker.start()
+
     def cleanup(self):
-        pass
+        if self.audio is not None:
+            self.beat_tracker.stop()
+            self.audio.terminate()
+        self.bus.stop()
+        self.device_manager.close()
+        if STATS_DUMP:
+            dump_stats(self.device_manager.stats(), STATS_DUMP)
 
 def main():
+    if REALTIME_CPU is not None:
+        # Before any other thread starts, so they all stay off it
+        reserve_cpu(REALTIME_CPU)
     keyboards = Keyboards()
     try:
         print "Found %d keyboards" % len(keyboards.kbds)
@@ -706,12 +792,15 @@ def main():
 #keyboards.set_leds(False,False,False)
         #bus = FakeCanBus("/dev/ttyUSB0", 115200)
 #bus = CanBus("/dev/ttyUSB0", 115200)
-        #led_strip = FakeSingleBespeckleDevice("/dev/ttyUSB0", 115200)
-        led_strip = SingleBespeckleDevice("/dev/ttyUSB0", 115200)
-        device_manager = DeviceManager([led_strip])
+        #device_manager = load_topology(device_class=FakeSingleBespeckleDevice)
+        device_manager = load_topology(baudrate=BESPECKLE_BAUDRATE)
+        if WIRE_CAPTURE:
+            device_manager.set_recorder(WireRecorder(WIRE_CAPTURE))
         #effects_runner = EffectsRunner(bus)
         #[effects_runner.add_device(*dev) for dev in CAN_DEVICES.items()]
         ui = CursedLightUI(keyboards, device_manager)
+        if AUDIO_INPUT:
+            ui.listen(AUDIO_INPUT, AUDIO_LATENCY)
     except Exception:
         keyboards.stop()
         raise
@@ -25,6 +25,33 @@ CAN_DEVICE_GROUPS = {
 #    },
 }
 
+# Serial port each bespeckle device is attached to.
+# Devices sharing a port are driven as one device.
+BESPECKLE_PORTS = {
+    0x0003: "/dev/ttyUSB0",
+}
+BESPECKLE_BAUDRATE = 115200
+# Write a packet straight from the sending thread when the device's writer is
+# idle, instead of handing it over. Much cheaper on ports whose writes return at
+# once (pty, USB serial); on a port that blocks until the bytes are on the wire,
+# the sender waits out each write in turn, so set False there
+WRITE_INLINE = True
+# Record all device traffic to this file for replay with wire.py (None to disable)
+WIRE_CAPTURE = None
+# Per-device output statistics are written here at exit (None to disable)
+STATS_DUMP = "/tmp/cl_stats.json"
+# What to do when all 256 effect ids on a device are taken: "lru", "oldest" or "refuse"
+EFFECT_ID_POLICY = "lru"
+# Drop effect messages that would leave the strip exactly as it is (see BespeckleDevice.shadow)
+SUPPRESS_REDUNDANT = True
+
+# Show library to load patterns from, written with bank.write_bank (None for ten blank patterns)
+PATTERN_BANK = None
+# Most patterns kept built at once; active ones are always kept
+PATTERN_CACHE = 64
+# File the numpad scenes are loaded from and saved to as they are captured (None to keep them for the session)
+SCENE_FILE = None
+
 GLOBAL_CALIBRATION = (1, 0.4, 0.4, 1)
 
 CAN_DEVICE_CALIBRATION = {
@@ -33,8 +60,42 @@ CAN_DEVICE_CALIBRATION = {
 }
 
 
+# Tick resolution: fracs per sequencer step (8 steps to a beat, so 240 fracs
+# per beat). Devices are ticked once a step; see `Timebase.set_resolution`
 FRACTICK_FRAC = 30
 SEND_BEATS = True
+# While any strip plays an offloaded pattern, start each beat with a sync
+# telling the strips which step of the bar comes next
+SEND_SYNC = True
+# New patterns have the strips play their steps (Pattern.offload), so the host only sends ticks, syncs and edits
+OFFLOAD_PATTERNS = False
+# Send the first tick of each beat as a probe the strips echo, to measure latency.
+# Only for strips known to echo FLAG_ACK frames: the serial ports in PROBE_PORTS (None for every port)
+PROBE_LATENCY = False
+PROBE_PORTS = None
+# How the device tick thread waits for the next tick: "deadline" or "poll"
+TICK_SCHEDULER = "deadline"
+# Run the tick and device writer threads on this CPU, and keep every other
+# thread off it (None to share all CPUs)
+REALTIME_CPU = None
+# SCHED_FIFO priority (1-99) for those threads, where permitted (None for the default scheduler)
+REALTIME_PRIORITY = None
+# When the engine falls behind: "all" replays the missed steps in order, "final"
+# jumps straight to the current step, "drop" skips the late update altogether
+CATCH_UP = "all"
+# Run patterns and queue device ticks this many fracs ahead of each step, then
+# release each tick at the step's time minus that device's latency, so every
+# strip renders on the beat. 0 disables; must be less than FRACTICK_FRAC
+LOOKAHEAD_FRACS = 0
+# Start and stop patterns on the next "step", "beat" or "bar" (None for right away),
+# or on every LAUNCH_MULTIPLE of them
+LAUNCH_QUANTIZE = "bar"
+LAUNCH_MULTIPLE = 1
+# Follow the beat of live audio: a command that writes raw signed 16-bit mono
+# 44.1kHz PCM to stdout, e.g. "arecord -q -f S16_LE -r 44100 -c 1 -t raw" (None to disable)
+AUDIO_INPUT = None
+# How far the audio input lags behind the sound in the room, in seconds
+AUDIO_LATENCY = 0.0
 
 # Multicast
 CAN_ALL_ADDRESS = 0x0000
@@ -1,63 +1,441 @@
+import Queue
+import collections
 import logging
 import threading
 import serial
 import time
 
+from config import *
+from framing import FrameDecoder, FrameEncoder, cobs_encode, packet_len
+from stats import Histogram
+from timing import TickBus, Timebase, monotonic_ns, realtime_thread
+
 logger = logging.getLogger(__name__)
 
 class DeviceManager(object):
-    def __init__(self, devices):
+    """
+    Owns every physical device, and the groups that commands are addressed to.
+
+    `devices` - every `SingleBespeckleDevice`, one per serial port
+    `groups` - name -> `BespeckleDeviceGroup`; each device is in exactly one group
+    `all_devices` - group over every device, used to broadcast ticks
+    """
+    def __init__(self, devices, groups=None):
         self.devices = devices
-        self.last_tick = (0, 0)
-        self.run_ticks = True
-        self.skipped = 0
+        for i, dev in enumerate(devices):
+            dev.index = i
+        if groups is None:
+            groups = [("All", BespeckleDeviceGroup(devices, "All"))]
+        self.groups = collections.OrderedDict(groups)
+        self.all_devices = BespeckleDeviceGroup(devices, "All")
+        self.probing = any(dev.probing for dev in devices)
+        self.timebase = None
+        self.window_period = None
+        self.bus = None
+        self.recorder = None
         self.init()
 
     def init(self):
-        for dev in self.devices:
-            dev.reset()
+        self.all_devices.reset()
+        for group in self.groups.values():
+            group.effect_ids.reset()
+            with group.shadow_lock:
+                group.shadow.clear()
+                group.synced.clear()
+
+    @property
+    def default_group(self):
+        return self.groups.values()[0]
         
-    def set_timebase(self, timebase):
-        self.timebase = timebase
-        def run_ticks():
-            ltick = None
-            while self.run_ticks:
-                t = self.timebase.tick()
-                if t:
-                    if t != ltick:
-                        self.tick(t)
-                        self.skipped = self.timebase.difference(ltick or (0,0), t)
-                        ltick = t[:]
-                time.sleep(0.0001)
-        self.tick_thread = threading.Thread(target=run_ticks)
-        self.tick_thread.daemon = True
-        self.tick_thread.start()
-
-    def tick(self, tick):
-        if tick == self.last_tick:
-            return None
-        beat, fractick = tick
-        if tick[0] != self.last_tick[0]:
-            fractick = 0
+    def set_tick_bus(self, bus, lookahead=LOOKAHEAD_FRACS):
+        # Devices are ticked once a step from the bus thread, `lookahead` fracs early
+        if not 0 <= lookahead < Timebase.step_fracs:
+            raise Exception("Look-ahead must be less than a step (%d fracs)" % Timebase.step_fracs)
+        self.bus = bus
+        self.timebase = bus.timebase
+        self.window_period = None
+        bus.subscribe(self.tick, TickBus.STEP, lead=lookahead)
+
+    @property
+    def skipped(self):
+        if self.bus is None:
+            return 0
+        return self.bus.skipped
 
-        tick = (beat, fractick)
-        if SEND_BEATS and (fractick % FRACTICK_FRAC) == 0:
+    def tick(self, tick, at=None):
+        # With `at`, each device holds the tick until `at` less its own latency
+        beat, fractick = tick
+        if self.timebase is not None and self.timebase.state[1] != self.window_period:
+            # Lower-priority traffic gets what the link can carry in one step, so only tempo changes it
+            self.window_period = self.timebase.state[1]
+            window = self.window_period / 1e9 / self.timebase.steps
             for dev in self.devices:
-                dev.tick(tick)
-        
-        self.last_tick = tick
+                dev.set_budget_window(window)
+        if SEND_BEATS:
+            if SEND_SYNC:
+                # Which step of the bar the next tick is, to keep the strips' sequencers in time
+                for group in self.groups.values():
+                    if group.sync_due or (group.synced and fractick < Timebase.step_fracs):
+                        group.sync_due = False
+                        group.sync(Timebase.step_of(tick), at)
+            # Encoded once, then queued to every device's writer in parallel
+            if self.probing and fractick < Timebase.step_fracs:
+                self.all_devices.probe(at)
+            else:
+                self.all_devices.tick(at)
 
     def reset(self):
+        self.init()
+
+    def force_resync(self, device=None):
+        # Rebuild the effects on `device` (default: every device) from its group's shadow
+        for group in self.groups.values():
+            for dev in group.devices:
+                if device is None or dev is device:
+                    group.force_resync(dev)
+
+    @property
+    def suppressed(self):
+        # (messages, bytes) not sent because the strips already had them
+        groups = self.groups.values()
+        return sum(group.suppressed for group in groups), sum(group.bytes_saved for group in groups)
+
+    def flush(self):
         for dev in self.devices:
-            self.dev.reset()
+            dev.flush()
 
+    def stats(self):
+        return {
+            "ticks_skipped": self.skipped,
+            "scheduler": self.bus.report() if self.bus is not None else None,
+            "devices": [dev.stats() for dev in self.devices],
+            "groups": dict((name, group.effect_ids.stats()) for name, group in self.groups.items()),
+            "suppressed": dict((name, {"messages": group.suppressed, "bytes_saved": group.bytes_saved, "resyncs": group.resyncs})
+                               for name, group in self.groups.items()),
+        }
+
+    def set_recorder(self, recorder):
+        # Capture everything written to any device; see wire.py
+        self.recorder = recorder
+        for dev in self.devices:
+            dev.recorder = recorder
 
     def close(self):
-        self.run_ticks = False
+        for dev in self.devices:
+            dev.close()
+        if self.recorder is not None:
+            self.recorder.close()
 
-class SingleBespeckleDevice(object):
+def load_topology(groups=CAN_DEVICE_GROUPS, ports=BESPECKLE_PORTS, device_class=None, **kwargs):
     """
-    Abstraction for sending data to a single Bespeckle-based device
+    Build a `DeviceManager` from the device topology in config.py:
+    one device per serial port in `ports` (uid -> port), gathered into the
+    named `groups` (name -> {uid: description}).
+    Devices not mentioned in any group get a group of their own.
+    Extra keyword arguments are passed to `device_class`.
+    """
+    if device_class is None:
+        device_class = SingleBespeckleDevice
+    by_port = collections.OrderedDict()
+    for uid, port in sorted(ports.items()):
+        if port not in by_port:
+            by_port[port] = device_class(port, **kwargs)
+
+    grouped = set()
+    group_list = []
+    for name, uids in sorted(groups.items()):
+        devs = []
+        for uid in sorted(uids):
+            if uid not in ports:
+                logger.warning("Device 0x%04x in group '%s' has no serial port", uid, name)
+                continue
+            dev = by_port[ports[uid]]
+            if dev in devs:
+                continue
+            if ports[uid] in grouped:
+                raise Exception("Device on %s is in more than one group" % ports[uid])
+            grouped.add(ports[uid])
+            devs.append(dev)
+        if devs:
+            group_list.append((name, BespeckleDeviceGroup(devs, name)))
+    for port, dev in by_port.items():
+        if port not in grouped:
+            group_list.append((port, BespeckleDeviceGroup([dev], port)))
+
+    return DeviceManager(list(by_port.values()), group_list)
+
+class TransmitQueue(object):
+    """
+    Bounded queue of encoded packets waiting to be written to a device.
+
+    Packets are put in priority lanes; the writer always takes from the
+    lowest-numbered non-empty lane, first in first out within a lane.
+    A packet put with a `release` time (monotonic ns) is held, along with
+    everything behind it in its lane, until then.
+    Lane 0 is never shed. Packets in the other lanes are only accepted if,
+    together with everything queued ahead of them, they can go out within
+    `window` seconds at `baudrate` (10 bits per byte). Over that budget, a
+    packet replaces the one already waiting in its lane with the same `key`
+    (`coalesced`), or else is dropped (`shed`). In lanes not listed in
+    `coalesce` (default: every lane), packets are edges that must all arrive
+    in order, so one with the same key as a waiting packet is queued behind
+    it, budget or not.
+
+    `put` never blocks: if the writer has fallen `maxsize` packets behind,
+    the new packet is dropped and counted in `dropped`.
+    `claim` lets the caller write a packet itself when nothing is queued or
+    being written; the writer waits until it calls `task_done`.
+    Also tracks the deepest the queue has been (`max_depth`), how long
+    packets sit in it past their release (`last_wait`, `waits`), and how
+    many waited longer than one window (`late`).
+    """
+    def __init__(self, maxsize=256, lanes=3, baudrate=115200, window=0.0625, coalesce=None):
+        self.maxsize = maxsize
+        self.coalesce = range(1, lanes) if coalesce is None else coalesce
+        self.lanes = [collections.deque() for i in range(lanes)]
+        self.lane_bytes = [0] * lanes
+        self.depth = 0
+        self.baudrate = baudrate
+        self.window = window
+        lock = threading.Lock()
+        self.cond = threading.Condition(lock)
+        # `join` waits on its own condition, so finished writes don't wake the writer
+        self.idle = threading.Condition(lock)
+        self.unfinished = 0
+        self.writing = False
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.shed = 0
+        self.coalesced = 0
+        self.late = 0
+        self.max_depth = 0
+        self.last_wait = 0.0
+        self.waits = Histogram()
+
+    def __len__(self):
+        return self.depth
+
+    @property
+    def budget(self):
+        # Bytes the link can carry in one window
+        return int(self.baudrate * self.window / 10)
+
+    def put(self, data, lane=0, key=None, release=None):
+        with self.cond:
+            if self.closed:
+                self.dropped += 1
+                return False
+            if lane and sum(self.lane_bytes[0:lane + 1]) + len(data) > self.budget:
+                entry = next((entry for entry in self.lanes[lane] if key is not None and entry[2] == key), None)
+                if entry is None:
+                    self.shed += 1
+                    return False
+                if lane in self.coalesce:
+                    self.lane_bytes[lane] += len(data) - len(entry[1])
+                    entry[1] = data
+                    self.coalesced += 1
+                    return True
+            if self.depth >= self.maxsize:
+                self.dropped += 1
+                return False
+            self.lanes[lane].append([monotonic_ns(), data, key, release])
+            self.lane_bytes[lane] += len(data)
+            self.depth += 1
+            self.unfinished += 1
+            if self.depth > self.max_depth:
+                self.max_depth = self.depth
+            self.cond.notify_all()
+        return True
+
+    def claim(self):
+        # True if the caller may write one packet now, ahead of anything put later
+        with self.cond:
+            if self.closed or self.depth or self.writing:
+                return False
+            self.writing = True
+            self.unfinished += 1
+            return True
+
+    def purge(self, key):
+        # Drop every queued packet with `key` outside of lane 0
+        with self.cond:
+            for lane in range(1, len(self.lanes)):
+                entries = self.lanes[lane]
+                keep = [entry for entry in entries if entry[2] != key]
+                removed = len(entries) - len(keep)
+                if removed:
+                    self.lanes[lane] = collections.deque(keep)
+                    self.lane_bytes[lane] = sum(len(entry[1]) for entry in keep)
+                    self.depth -= removed
+                    self.unfinished -= removed
+                    self.shed += removed
+                    if not self.unfinished:
+                        self.idle.notify_all()
+
+    def get(self):
+        # Block until a packet is available and released; returns None once closed
+        with self.cond:
+            while True:
+                while not self.depth or self.writing:
+                    if self.closed and not self.depth:
+                        return None
+                    self.cond.wait()
+                now = monotonic_ns()
+                due = None
+                for lane, entries in enumerate(self.lanes):
+                    if not entries:
+                        continue
+                    release = entries[0][3]
+                    if release is None or release <= now:
+                        queued_at, data, key, release = entries.popleft()
+                        self.lane_bytes[lane] -= len(data)
+                        self.depth -= 1
+                        self.writing = True
+                        break
+                    if due is None or release < due:
+                        due = release
+                else:
+                    self.cond.wait((due - now) / 1e9)
+                    continue
+                break
+        wait = (monotonic_ns() - max(queued_at, release)) / 1e9
+        self.last_wait = wait
+        self.waits.record(wait)
+        if wait > self.window:
+            self.late += 1
+        return data
+
+    def task_done(self):
+        with self.cond:
+            self.writing = False
+            self.sent += 1
+            self.unfinished -= 1
+            if self.depth:
+                self.cond.notify_all()
+            if not self.unfinished:
+                self.idle.notify_all()
+
+    def join(self):
+        # Block until every queued packet has been written
+        with self.cond:
+            while self.unfinished:
+                self.idle.wait()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            self.idle.notify_all()
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "shed": self.shed,
+            "coalesced": self.coalesced,
+            "late": self.late,
+            "wait": self.waits.to_dict(),
+        }
+
+class EffectIdAllocator(object):
+    """
+    Constant-time allocator for the 256 bespeckle effect ids.
+
+    Free ids are handed out from a FIFO free list, so a released id is
+    reused as late as possible. Ids in use are kept in allocation order,
+    or least-recently-touched first for the "lru" policy.
+    When every id is taken, `policy` decides what `allocate` does:
+    `lru` - evict the effect that was touched least recently
+    `oldest` - evict the effect that was allocated first
+    `refuse` - allocate nothing and return None
+    Each id in use keeps its owner's eviction callback, so whoever held an
+    evicted id can be told to stop using it. Safe to call from any thread.
+    """
+    POLICIES = ("lru", "oldest", "refuse")
+
+    def __init__(self, size=256, policy="lru"):
+        if policy not in self.POLICIES:
+            raise Exception("Unknown effect id policy '%s'" % policy)
+        self.size = size
+        self.policy = policy
+        self.peak = 0
+        self.evictions = 0
+        self.refusals = 0
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.free = collections.deque(range(self.size))
+            # id -> eviction callback or None
+            self.used = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.used)
+
+    def __contains__(self, effect_id):
+        return effect_id in self.used
+
+    def allocate(self, on_evict=None):
+        """
+        Returns (id, evicted id or None, the evicted owner's callback or None);
+        id is None if refused. `on_evict(id)` is for the caller to run if
+        this id is later taken for another effect.
+        """
+        with self.lock:
+            evicted = callback = None
+            if self.free:
+                effect_id = self.free.popleft()
+            elif self.policy == "refuse":
+                self.refusals += 1
+                return None, None, None
+            else:
+                effect_id, callback = self.used.popitem(last=False)
+                evicted = effect_id
+                self.evictions += 1
+            self.used[effect_id] = on_evict
+            if len(self.used) > self.peak:
+                self.peak = len(self.used)
+            return effect_id, evicted, callback
+
+    def own(self, effect_id, on_evict):
+        # Hand an id in use to a new owner
+        with self.lock:
+            if effect_id in self.used:
+                self.used[effect_id] = on_evict
+
+    def touch(self, effect_id):
+        with self.lock:
+            if self.policy == "lru" and effect_id in self.used:
+                self.used[effect_id] = self.used.pop(effect_id)
+
+    def release(self, effect_id):
+        with self.lock:
+            if effect_id in self.used:
+                del self.used[effect_id]
+                self.free.append(effect_id)
+
+    @property
+    def occupancy(self):
+        return len(self.used) / float(self.size)
+
+    def stats(self):
+        return {
+            "in_use": len(self.used),
+            "size": self.size,
+            "peak": self.peak,
+            "evictions": self.evictions,
+            "refusals": self.refusals,
+        }
+
+class BespeckleDevice(object):
+    """
+    The bespeckle command set, on top of `raw_packet`, which subclasses
+    override to reach a strip
     """
     CMD_SYNC = 0x80
     CMD_TICK = 0x88
@@ -67,89 +445,446 @@ class SingleBespeckleDevice(object):
     CMD_STOP = 0x82
     CMD_PARAM = 0x85
 
-    def __init__(self, port, baudrate=115200):
-        self.ser = serial.Serial(port, baudrate)
+    # Frame flag asking the strip to echo the frame back
+    FLAG_ACK = 0x01
+
+    # Transmit priority lanes, most urgent first
+    LANE_CONTROL = 0 # Sync, tick, reset, effect add/stop; never shed
+    LANE_STROBE = 1 # Strobe on/off edges
+    LANE_PARAM = 2 # Parameter changes
+    LANES = 3
+
+    # Effects whose every message does something (launches a pulse, restarts a swipe),
+    # so a repeated message is never redundant
+    TRIGGER_CLASSES = (0x14, 0x16)
+    # Effects that play in step with CMD_SYNC (see `Pattern.offload`)
+    SYNCED_CLASSES = (0x30,)
+
+    # Sent probes (see `probe`) rather than plain ticks
+    probing = False
+
+    def __init__(self):
+        self.encoder = FrameEncoder()
         self.addresses = {}
-        self.bespeckle_ids = set()
+        self.effect_ids = EffectIdAllocator(policy=EFFECT_ID_POLICY)
+        self.name = None
+        self.index = 0
+        self.recorder = None
+        self.probe_seq = 0
+        # What the strip should have: id -> [effect class, add data, last message or None].
+        # `shadow_lock` covers it, `synced`, and sending what changes them, so the
+        # strip sees changes in the order the shadow does
+        self.shadow = collections.OrderedDict()
+        self.shadow_lock = threading.Lock()
+        self.suppressed = 0
+        self.bytes_saved = 0
+        self.resyncs = 0
+        # Ids of effects in `SYNCED_CLASSES`; strips are only sent syncs while there are any
+        self.synced = set()
+        self.sync_due = False
+
+    def raw_packet(self, data, lane=LANE_CONTROL, key=None, at=None):
+        # `at` - monotonic ns the packet should reach the strip, if it should be held until then.
+        # Returns False if the packet was not queued, as here: this has nowhere to send it
+        logger.debug("%s: no link, dropping %d bytes", self.name, len(data))
+        return False
+
+    def ack_packet(self, data, match, at=None):
+        # Send `data`, which the strip will echo; `match` identifies the echo.
+        # Without a reader to match echoes, it is just sent
+        return self.raw_packet(data, at=at)
 
-    def raw_packet(self, data):
-        logger.debug("Serial Data: %s", ';'.join(map(lambda x: "{:02x}".format(x), data)))
-        #print ("Serial Data: %s", ';'.join(map(lambda x: "{:02x}".format(x), data)))
-        self.ser.write("".join([chr(d) for d in data]))
+    def purge(self, key):
+        # Forget queued packets for `key` that have not been sent yet
+        pass
 
     def cobs_packet(self, data):
-        #print ("Not encoded: %s", ';'.join(map(lambda x: "{:02x}".format(x), data)))
-        rdata = []
-        i = 0
-        for d in data[::-1]:
-            i += 1
-            if d == 0:
-                rdata.append(i)
-                i = 0
-            else:
-                rdata.append(d)
-        self.raw_packet([0, i+1] + rdata[::-1])
-        
+        self.raw_packet(cobs_encode(data))
 
-    def framed_packet(self, data=None, flags=0x00, addr=0x00):
-        if data is None or len(data) > 250:
+    def framed_packet(self, data=None, flags=0x00, addr=0x00, lane=LANE_CONTROL, key=None):
+        if data is None:
             raise Exception("invalid data")
-        while len(data) < 8:
-            data.append(0)
-        crc_frame = [flags, addr] + data
-        checksum = sum(crc_frame) & 0xff
-        frame = [len(data), checksum] + crc_frame
-        self.cobs_packet(frame)
-
-    def _get_next_id(self):
-        for i in range(256):
-            if i not in self.bespeckle_ids:
-                return i
-        return 0xff # Just overwrite the last effect. lololol
+        return self.raw_packet(self.encoder.encode(data, flags, addr), lane, key)
+
+    @property
+    def fanout(self):
+        # Devices each packet is written to
+        return 1
 
     #def tick(self, time):
     #    beat, frac = time
     #    self.framed_packet([self.CMD_TICK, frac])
 
-    def tick(self):
-        self.framed_packet([self.CMD_TICK])
+    def tick(self, at=None):
+        self.raw_packet(self.encoder.cached([self.CMD_TICK]), at=at)
 
-    def sync(self, f=0):
-        self.framed_packet([self.CMD_SYNC, f])
+    def probe(self, at=None):
+        # A tick that the strip echoes back, tagged with a sequence number, to time the round trip
+        self.probe_seq = (self.probe_seq + 1) & 0xff
+        packet = self.encoder.encode([self.CMD_TICK, 0, self.probe_seq], flags=self.FLAG_ACK)
+        self.ack_packet(packet, (self.CMD_TICK, self.probe_seq), at)
+
+    def sync(self, f=0, at=None):
+        self.raw_packet(self.encoder.cached([self.CMD_SYNC, f]), at=at)
    
     def reset(self):
-        self.framed_packet([self.CMD_RESET])
+        self.raw_packet(self.encoder.cached([self.CMD_RESET]))
         #TODO: Send Calibration
         #for i, gc in enumerate(CAN_DEVICE_CALIBRATION.get(uid, GLOBAL_CALIBRATION)):
         #    self.canbus.send_to_all([self.canbus.CMD_PARAM, i, int(255.0 * gc) ,0,0, 0,0,0])
-        self.bespeckle_ids = set()
+        self.effect_ids.reset()
+        with self.shadow_lock:
+            self.shadow.clear()
+            self.synced.clear()
+
+    def force_resync(self, device=None):
+        """
+        Reset the strip and rebuild its effects from `shadow`, for when it is
+        suspected to have missed something. `device` - just that member of
+        the group (default: everything this sends to).
+        """
+        target = device or self
+        with self.shadow_lock:
+            target.raw_packet(target.encoder.cached([self.CMD_RESET]))
+            for bespeckle_id, (bespeckle_class, data, msg) in self.shadow.items():
+                target.framed_packet([bespeckle_class, bespeckle_id] + list(data))
+                if msg is not None:
+                    target.framed_packet([self.CMD_MSG, bespeckle_id] + list(msg))
+            self.resyncs += 1
 
-    def bespeckle_add_effect(self, bespeckle_class, data=None):
+    def bespeckle_add_effect(self, bespeckle_class, data=None, on_evict=None):
+        """
+        Returns None if there is no id for the effect (see `EFFECT_ID_POLICY`).
+        `on_evict(id)` is called if the id is later taken for another effect;
+        the owner must then stop using it, as it no longer refers to its effect.
+        """
         if data is None:
             data = []
-        bespeckle_id = self._get_next_id()
-        self.bespeckle_ids.add(bespeckle_id)
-        self.framed_packet([bespeckle_class, bespeckle_id] + list(data))
+        with self.shadow_lock:
+            bespeckle_id, evicted, callback = self.effect_ids.allocate(on_evict)
+            if bespeckle_id is None:
+                logger.warning("%s: out of effect ids, not adding effect 0x%02x", self.name, bespeckle_class)
+                return None
+            if evicted is not None:
+                # The new effect replaces the evicted one on the device
+                logger.warning("%s: out of effect ids, evicting effect %d", self.name, evicted)
+                self.purge(evicted)
+                self.shadow.pop(evicted, None)
+                self.synced.discard(evicted)
+            self.framed_packet([bespeckle_class, bespeckle_id] + list(data))
+            self.shadow[bespeckle_id] = [bespeckle_class, tuple(data), None]
+            if bespeckle_class in self.SYNCED_CLASSES:
+                self.synced.add(bespeckle_id)
+                # Don't leave it to the next beat to find its step
+                self.sync_due = True
+            else:
+                self.synced.discard(bespeckle_id)
+        if callback is not None:
+            # Outside the lock, so the owner can send to the device
+            callback(evicted)
         return bespeckle_id
 
     def bespeckle_pop_effect(self, bespeckle_id):
-        if bespeckle_id in self.bespeckle_ids:
-            self.bespeckle_ids.discard(bespeckle_id)
-        self.framed_packet([self.CMD_STOP, bespeckle_id])
+        with self.shadow_lock:
+            self.effect_ids.release(bespeckle_id)
+            # Pending messages would otherwise land on whatever reuses the id
+            self.purge(bespeckle_id)
+            self.shadow.pop(bespeckle_id, None)
+            self.synced.discard(bespeckle_id)
+            self.framed_packet([self.CMD_STOP, bespeckle_id])
         return True
 
-    def bespeckle_msg_effect(self, bespeckle_id, data=None):
+    def bespeckle_msg_effect(self, bespeckle_id, data=None, lane=LANE_PARAM):
+        # Dropped if the strip already has exactly this message (see `shadow`)
         if data is None:
             data = []
-        self.framed_packet([self.CMD_MSG, bespeckle_id] + list(data))
+        self.effect_ids.touch(bespeckle_id)
+        msg = tuple(data)
+        with self.shadow_lock:
+            effect = self.shadow.get(bespeckle_id)
+            if SUPPRESS_REDUNDANT and effect is not None and effect[2] == msg and effect[0] not in self.TRIGGER_CLASSES:
+                self.suppressed += 1
+                self.bytes_saved += packet_len(2 + len(data)) * self.fanout
+                return bespeckle_id
+            queued = self.framed_packet([self.CMD_MSG, bespeckle_id] + list(data), lane=lane, key=bespeckle_id)
+            if effect is not None:
+                # A shed message never made it, so the strip's state is no longer known
+                effect[2] = msg if queued else None
         return bespeckle_id
 
+class SingleBespeckleDevice(BespeckleDevice):
+    """
+    Abstraction for sending data to a single Bespeckle-based device
+
+    Packets are queued and written to the port by a dedicated writer thread,
+    so sending a command never waits for the link. With `write_inline` (see
+    WRITE_INLINE), a packet sent while the writer is idle and that is not held
+    for a release time is written by the sender instead, saving the hand-over.
+
+    A reader thread decodes frames coming back from the strip. Echoes of
+    probes (see `probe`) give the round-trip time; `latency` is half the
+    median of the last few. The strip is `behind` if it has echoed before
+    and several probes are now waiting for an echo, and a reset frame it
+    sends on its own is counted as a reboot. Probes still waiting after
+    RTT_EXPIRY round trips (and at least PROBE_TIMEOUT seconds) are given
+    up on, and count as lost once the strip has been seen to echo.
+    """
+    READ_TIMEOUT = 0.1
+    RTT_WINDOW = 16
+    MAX_UNACKED = 4
+    RTT_EXPIRY = 4
+    PROBE_TIMEOUT = 1.0
+
+    def __init__(self, port, baudrate=115200, queue_size=256):
+        super(SingleBespeckleDevice, self).__init__()
+        self.ser = serial.Serial(port, baudrate, timeout=self.READ_TIMEOUT)
+        self.name = port
+        self.baudrate = baudrate
+        self.start_writer(queue_size)
+        self.start_reader()
+
+    def start_writer(self, queue_size=256):
+        # A strobe "off" must not replace the "on" still waiting ahead of it
+        self.tx = TransmitQueue(queue_size, self.LANES, self.baudrate, coalesce=(self.LANE_PARAM,))
+        self.write_inline = WRITE_INLINE
+        self.write_latency = Histogram()
+        self.bytes_sent = 0
+        self.writer_thread = threading.Thread(target=self.run_writer)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def run_writer(self):
+        if REALTIME_CPU is not None or REALTIME_PRIORITY is not None:
+            realtime_thread(REALTIME_CPU, REALTIME_PRIORITY)
+        while True:
+            data = self.tx.get()
+            if data is None:
+                return
+            self.send(data)
+
+    def send(self, data):
+        # Called by whoever claimed the write: the writer thread or, inline, the sender
+        if self.recorder is not None:
+            self.recorder.record(self.index, data)
+        match = self.ack_packets.pop(data, None) if self.ack_packets else None
+        start = time.time()
+        if match is not None:
+            # Timed from the start of the write, so `latency` covers the
+            # time on the wire. Registered first in case the echo beats us back
+            with self.ack_lock:
+                self.expire_unacked(start)
+                self.unacked[match] = start
+        try:
+            self.write(data)
+        except Exception:
+            logger.exception("Unable to write to device")
+        self.write_latency.record(time.time() - start)
+        self.bytes_sent += len(data)
+        self.tx.task_done()
+
+    def write(self, data):
+        # Called by one thread at a time (see `send`)
+        self.ser.write(data)
+
+    def start_reader(self):
+        self.ack_packets = {} # Packet -> match, until written
+        self.unacked = collections.OrderedDict() # Match -> time written
+        self.ack_lock = threading.Lock()
+        self.rtt = Histogram()
+        self.rtt_window = collections.deque(maxlen=self.RTT_WINDOW)
+        self.last_ack = None
+        self.lost = 0
+        self.reboots = 0
+        self.decoder = FrameDecoder()
+        self.reading = True
+        self.reader_thread = threading.Thread(target=self.run_reader)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+
+    def run_reader(self):
+        while self.reading:
+            try:
+                chunk = self.read()
+            except Exception:
+                logger.exception("Unable to read from device")
+                time.sleep(self.READ_TIMEOUT)
+                continue
+            if chunk:
+                for flags, addr, data in self.decoder.feed(chunk):
+                    self.received(flags, addr, data)
+
+    def read(self):
+        # Called from the reader thread only; returns within READ_TIMEOUT
+        return self.ser.read(self.ser.inWaiting() or 1)
+
+    def wake_reader(self):
+        # Make a blocked `read` return so the reader thread can exit
+        pass
+
+    def received(self, flags, addr, data):
+        now = time.time()
+        if flags & self.FLAG_ACK:
+            match = (data[0], data[2])
+            with self.ack_lock:
+                if match not in self.unacked:
+                    return
+                # Anything sent before this probe is not coming back
+                while True:
+                    key, sent = self.unacked.popitem(last=False)
+                    if key == match:
+                        break
+                    self.lost += 1
+            rtt = now - sent
+            self.rtt.record(rtt)
+            self.rtt_window.append(rtt)
+            self.last_ack = now
+        elif data[0] == self.CMD_RESET:
+            self.reboots += 1
+            logger.warning("%s: device reset itself", self.name)
+
+    def expire_unacked(self, now):
+        # Called with `ack_lock` held
+        timeout = max(self.PROBE_TIMEOUT, self.RTT_EXPIRY * 2 * self.latency)
+        for key, sent in self.unacked.items():
+            if now - sent < timeout:
+                break
+            del self.unacked[key]
+            if self.last_ack is not None:
+                self.lost += 1
+
+    @property
+    def latency(self):
+        # One-way latency estimate, in seconds
+        if not self.rtt_window:
+            return 0.0
+        return sorted(self.rtt_window)[len(self.rtt_window) // 2] / 2
+
+    @property
+    def behind(self):
+        # Strips that never echo probes are never behind
+        return self.last_ack is not None and len(self.unacked) > self.MAX_UNACKED
+
+    def raw_packet(self, data, lane=BespeckleDevice.LANE_CONTROL, key=None, at=None):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Serial Data: %s", ';'.join(map(lambda x: "{:02x}".format(x), bytearray(data))))
+        if at is None and self.write_inline and self.tx.claim():
+            self.send(data)
+            return True
+        release = None
+        if at is not None:
+            # Compensate for this strip's measured latency
+            release = at - int(self.latency * 1e9)
+        return self.tx.put(data, lane, key, release)
+
+    @property
+    def probing(self):
+        # Whether this strip gets probes (see PROBE_PORTS)
+        return PROBE_LATENCY and (PROBE_PORTS is None or self.name in PROBE_PORTS)
+
+    def ack_packet(self, data, match, at=None):
+        # Registered first in case the writer takes it straight away; forgotten again if it was never queued
+        self.ack_packets[data] = match
+        if not self.raw_packet(data, at=at):
+            self.ack_packets.pop(data, None)
+
+    def purge(self, key):
+        self.tx.purge(key)
+
+    def set_budget_window(self, window):
+        self.tx.window = window
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "bytes_sent": self.bytes_sent,
+            "write_latency": self.write_latency.to_dict(),
+            "queue": self.tx.stats(),
+            "rtt": self.rtt.to_dict(),
+            "latency": self.latency,
+            "unacked": len(self.unacked),
+            "lost": self.lost,
+            "reboots": self.reboots,
+            "rx_errors": self.decoder.errors,
+        }
+
+    def flush(self):
+        self.tx.join()
+
+    def close(self):
+        # Lets the writer finish what is already queued
+        self.tx.close()
+        self.writer_thread.join()
+        self.reading = False
+        self.wake_reader()
+        self.reader_thread.join()
+        if self.ser is not None:
+            self.ser.close()
+
+class BespeckleDeviceGroup(BespeckleDevice):
+    """
+    Several devices that all get the same set of commands.
+
+    Each packet is encoded once and queued to every member, whose writer
+    threads then send it in parallel. The group owns the effect ids of its
+    members, so a device should only be addressed through one group.
+    """
+    def __init__(self, devices, name=None):
+        super(BespeckleDeviceGroup, self).__init__()
+        self.devices = devices
+        self.name = name
+
+    def raw_packet(self, data, lane=BespeckleDevice.LANE_CONTROL, key=None, at=None):
+        queued = True
+        for dev in self.devices:
+            queued = dev.raw_packet(data, lane, key, at) and queued
+        return queued
+
+    @property
+    def fanout(self):
+        return len(self.devices)
+
+    def ack_packet(self, data, match, at=None):
+        # Strips that aren't probed get a plain tick instead
+        for dev in self.devices:
+            if dev.probing:
+                dev.ack_packet(data, match, at)
+            else:
+                dev.tick(at)
+
+    def purge(self, key):
+        for dev in self.devices:
+            dev.purge(key)
+
+    def flush(self):
+        for dev in self.devices:
+            dev.flush()
+
+    def __str__(self):
+        return "{} ({})".format(self.name, len(self.devices))
+
 class FakeSingleBespeckleDevice(SingleBespeckleDevice):
-    def __init__(self, *args, **kwargs):
-        self.addresses = {}
-        self.bespeckle_ids = set()
+    """
+    Stand-in device that takes as long as a real link at `baudrate`
+    to "write" each packet (10 bits per byte), without any port.
+    It never answers, unless something puts data in `rx`.
+    """
+    def __init__(self, port=None, baudrate=115200, queue_size=256):
+        BespeckleDevice.__init__(self)
+        self.ser = None
+        self.name = port
+        self.baudrate = baudrate
+        self.rx = Queue.Queue()
+        self.start_writer(queue_size)
+        # Its writes stand in for the time on the wire, which a real port spends after `write` returns
+        self.write_inline = False
+        self.start_reader()
+
+    def write(self, data):
+        time.sleep(len(data) * 10.0 / self.baudrate)
 
-    def raw_packet(self, data):
-        logger.debug("Data: %s", ';'.join(map(lambda x: "{:02x}".format(x), data)))
-        time.sleep(0.001)
+    def read(self):
+        # Whatever has been put in `rx`, as if the strip had sent it
+        return self.rx.get()
 
+    def wake_reader(self):
+        self.rx.put(b"")
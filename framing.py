@@ -0,0 +1,160 @@
+"""
+Bespeckle wire framing.
+
+A frame on the wire is a 0x00 delimiter followed by the COBS-encoded body:
+    [len(data), checksum, flags, addr] + data
+`data` is padded with zeros to at least 8 bytes, and `checksum` is the low
+byte of the sum of `[flags, addr] + data`.
+"""
+import threading
+
+MIN_DATA_LEN = 8
+MAX_DATA_LEN = 250
+FRAME_HEADER_LEN = 4
+# Delimiter + COBS code byte + header + data
+MAX_PACKET_LEN = 2 + FRAME_HEADER_LEN + MAX_DATA_LEN
+
+def packet_len(n):
+    # Bytes on the wire for a frame of `n` data bytes, without encoding it
+    return 2 + FRAME_HEADER_LEN + max(n, MIN_DATA_LEN)
+
+class FrameEncoder(object):
+    """
+    Encode bespeckle frames into preallocated buffers.
+
+    The frame body is assembled in `self.frame` and COBS-encoded in a single
+    forward pass into `self.out`; only the final packet is copied out.
+    Encoding is serialized with a lock since devices are driven from both
+    the UI loop and the tick thread.
+
+    `cached(data)` memoizes the encoded packet for constant commands
+    (tick, reset, sync), which make up most of the traffic.
+    """
+    def __init__(self):
+        self.frame = bytearray(FRAME_HEADER_LEN + MAX_DATA_LEN)
+        self.out = bytearray(MAX_PACKET_LEN)
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def encode(self, data, flags=0x00, addr=0x00):
+        n = len(data)
+        if n > MAX_DATA_LEN:
+            raise Exception("invalid data")
+        with self.lock:
+            frame = self.frame
+            frame[4:4 + n] = data # Raises if any byte is out of range
+            if n < MIN_DATA_LEN:
+                frame[4 + n:4 + MIN_DATA_LEN] = bytearray(MIN_DATA_LEN - n)
+                n = MIN_DATA_LEN
+            frame[0] = n
+            frame[1] = (sum(frame[4:4 + n]) + flags + addr) & 0xff
+            frame[2] = flags
+            frame[3] = addr
+            size = cobs_encode_into(frame, FRAME_HEADER_LEN + n, self.out)
+            return bytes(self.out[:size])
+
+    def cached(self, data, flags=0x00, addr=0x00):
+        key = (tuple(data), flags, addr)
+        packet = self.cache.get(key)
+        if packet is None:
+            packet = self.cache[key] = self.encode(data, flags, addr)
+        return packet
+
+def cobs_encode_into(src, n, out):
+    """
+    COBS-encode the first `n` bytes of `src` into `out`, prefixed with the
+    0x00 frame delimiter. Returns the number of bytes written.
+    Runs are not split at 254 bytes: frames are short enough to never need it.
+    """
+    out[0] = 0
+    code_idx = 1
+    code = 1
+    o = 2
+    for i in range(n):
+        d = src[i]
+        if d == 0:
+            out[code_idx] = code
+            code_idx = o
+            code = 1
+        else:
+            out[o] = d
+            code += 1
+        o += 1
+    out[code_idx] = code
+    return o
+
+def cobs_encode(data):
+    out = bytearray(len(data) + 2)
+    cobs_encode_into(bytearray(data), len(data), out)
+    return bytes(out)
+
+def cobs_decode(body):
+    """
+    Decode one COBS-encoded body, without its 0x00 delimiter.
+    Raises ValueError if the body is malformed or cut short.
+    """
+    body = bytearray(body)
+    out = bytearray()
+    i = 0
+    n = len(body)
+    while i < n:
+        code = body[i]
+        if code == 0 or i + code > n:
+            raise ValueError("bad COBS block")
+        out += body[i + 1:i + code]
+        i += code
+        if i < n:
+            out.append(0)
+    return out
+
+def decode_frame(body):
+    """
+    Decode and verify one frame body from the wire.
+    Returns `(flags, addr, data)`; raises ValueError on a bad length or checksum.
+    """
+    frame = cobs_decode(body)
+    if len(frame) < FRAME_HEADER_LEN or len(frame) != FRAME_HEADER_LEN + frame[0]:
+        raise ValueError("bad frame length")
+    if sum(frame[2:]) & 0xff != frame[1]:
+        raise ValueError("bad checksum")
+    return frame[2], frame[3], frame[4:]
+
+class FrameDecoder(object):
+    """
+    Splits a byte stream back into frames.
+
+    `feed(chunk)` returns the `(flags, addr, data)` of every frame completed
+    by `chunk`. Since frames are only delimited at the front, a frame is
+    taken as complete once its body decodes to the length in its header.
+    Frames that fail to decode are dropped and counted in `errors`.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.frames = 0
+        self.errors = 0
+
+    def feed(self, chunk):
+        self.buf += chunk
+        parts = self.buf.split(b"\0")
+        self.buf = parts.pop()
+        frames = []
+        for part in parts:
+            if part:
+                self._decode(part, frames)
+        if self.buf:
+            try:
+                frame = decode_frame(self.buf)
+            except ValueError:
+                pass # Wait for the rest of the frame
+            else:
+                self.buf = bytearray()
+                self.frames += 1
+                frames.append(frame)
+        return frames
+
+    def _decode(self, body, frames):
+        try:
+            frames.append(decode_frame(body))
+            self.frames += 1
+        except ValueError:
+            self.errors += 1
@@ -0,0 +1,567 @@
+import collections
+import logging
+import threading
+import time
+
+import numpy
+
+from channels import make_channel
+from config import *
+from timing import Timebase, monotonic_ns
+
+logger = logging.getLogger(__name__)
+
+class Pattern(object):
+    SEQ_LEN = Timebase.beats * Timebase.steps
+    CHANNELS = 8
+    # Effect class of the strips' sequencer, which plays a channel's program locked to the ticks
+    SEQUENCER_CLASS = 0x30
+    all_titles = set()
+    def __init__(self, device_manager, name=None):
+        self.device_manager = device_manager
+        self.engine = None
+        self._data = numpy.zeros((self.CHANNELS, self.SEQ_LEN), dtype=numpy.uint8)
+        self.channels = [[]  for i in range(self.CHANNELS)]
+        self.channels_muted = [False] * self.CHANNELS
+        self.speed = 1
+        self.active = False
+        self.keybinding = (None, None)
+        # Have the strips play the channels themselves (see `Channel.program`) rather than send every step
+        self.offload = OFFLOAD_PATTERNS
+        # Channel index -> [device, effect id, program last sent] while offloaded
+        self.programs = {}
+        # Serializes start, stop and uploads between the UI and the engine's thread
+        self.lock = threading.RLock()
+
+        if name is None:
+            name = "Pattern #%d" % (len(self.all_titles) + 1)
+        while name in self.all_titles:
+            name += "_"
+        self.all_titles.add(name)
+        self.title = name
+
+    @property
+    def data(self):
+        # (CHANNELS, SEQ_LEN) array; once added to a `PatternEngine`, a view of its storage
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data[...] = data
+        self.upload()
+
+    def get_channel_description(self, i):
+        channel = self.channels[i]
+        return "Channel %d: %s" % (i+1, str(channel)) #TODO
+
+    def tap(self, channel, beat, width=1, keyboard=True):
+        # User input to change pattern @ (channel, beat)
+        v = self.data[channel][beat]
+        self.data[channel][beat] = 1 - v
+        self.upload()
+
+    def toggle(self, quantum=None):
+        # With a `quantum` (fracs), start or stop at the engine's next multiple of it instead of now
+        if quantum and self.engine is not None:
+            self.engine.launch(self, quantum)
+            return
+        self.active = not self.active
+        if self.active:
+            self.start()
+        else:
+            self.stop()
+        if self.engine is not None:
+            self.engine.set_active(self, self.active)
+
+    @property
+    def pending(self):
+        # True while a quantized start or stop is waiting for its boundary
+        return self.engine is not None and self.engine.pending(self)
+
+    def start(self):
+        # Allocates every channel's effect on the devices; offloaded, a sequencer effect where the channel has a program
+        with self.lock:
+            for i, channel in enumerate(self.channels):
+                if channel is None or channel.started or i in self.programs:
+                    continue
+                program = channel.program(self.data[i]) if self.offload else None
+                if program is not None:
+                    device = channel.device
+                    bespeckle_id = device.bespeckle_add_effect(self.SEQUENCER_CLASS, program,
+                                                               on_evict=lambda evicted, i=i, device=device: self.evicted(i, device, evicted))
+                    if bespeckle_id is not None:
+                        self.programs[i] = [device, bespeckle_id, program]
+                        continue
+                channel.start()
+                logger.debug("STARTED")
+
+    def stop(self):
+        with self.lock:
+            for channel in self.channels:
+                if channel is not None:
+                    channel.stop()
+            for device, bespeckle_id, program in self.programs.values():
+                device.bespeckle_pop_effect(bespeckle_id)
+            self.programs = {}
+
+    def evicted(self, i, device, bespeckle_id):
+        # Channel `i`'s program lost its effect id to a newer effect. Takes no lock: it runs inside whoever added that
+        entry = self.programs.get(i)
+        if entry is not None and entry[0] is device and entry[1] == bespeckle_id:
+            self.programs.pop(i, None)
+
+    def upload(self):
+        # Send the strips every program changed by an edit since it was last sent
+        with self.lock:
+            for i, entry in self.programs.items():
+                device, bespeckle_id, program = entry
+                new = self.channels[i].program(self.data[i])
+                if new != program:
+                    # Never shed: the strip would play the old program until the next edit
+                    device.bespeckle_msg_effect(bespeckle_id, new, lane=device.LANE_CONTROL)
+                    entry[2] = new
+
+    def set_offload(self, offload):
+        # A running pattern moves over at once
+        with self.lock:
+            if offload == self.offload:
+                return
+            if self.active:
+                self.stop()
+            self.offload = offload
+            if self.active:
+                self.start()
+
+    def tick(self, time, at=None):
+        # Ticks every channel; `PatternEngine.tick` does the same for all patterns, for edges only
+        step = Timebase.step_of(time)
+        for channel, data in zip(self.channels, self.data):
+            if channel is not None:
+                channel.tick(time, data[step])
+
+    def serialize(self):
+        # Plain data only, so it can go through json; channels become descriptions
+        return {
+            "data": self.data.tolist(),
+            "channels": [channel.describe() if channel else None for channel in self.channels],
+            "title": self.title,
+            "keybinding": list(self.keybinding),
+            "offload": self.offload,
+            "_seqlen": self.SEQ_LEN,
+            "_channels": self.CHANNELS
+        }
+
+    @classmethod
+    def deserialize(cls, d, device_manager):
+        # Maybe there should be more checks. Don't mess around too much
+        if d["_seqlen"] != cls.SEQ_LEN:
+            raise Exception("Unable to deserialize pattern; mismatched seqlen (should be %d)" % cls.SEQ_LEN)
+        if d["_channels"] != cls.CHANNELS:
+            raise Exception("Unable to deserialize pattern; mismatched channels (should be %d)" % cls.CHANNELS)
+        p = cls(device_manager, name=d["title"])
+        p.data = d["data"]
+        group = device_manager.default_group if device_manager is not None else None
+        p.channels = [make_channel(group, c) for c in d["channels"]]
+        p.keybinding = tuple(d.get("keybinding", (None, None)))
+        p.offload = d.get("offload", OFFLOAD_PATTERNS)
+        return p
+
+    @classmethod
+    def new_template(cls, device_manager):
+        p = cls(device_manager, name="New Pattern")
+        p.channels = [None] * cls.CHANNELS
+        return p
+
+EXAMPLE_PATTERN_SERIALIZED = {
+    #"data": [[1,0,0,0] * 8, [1,0] * 16, [0,0,1,0,0,1,0,1] * 4] + [[0] * 32 for i in range(5)],
+    "data": [[0] * Pattern.SEQ_LEN for i in range(Pattern.CHANNELS)],
+    "channels": [None] * Pattern.CHANNELS,
+    "title": "Ex. Pattern",
+    "_seqlen": Pattern.SEQ_LEN,
+    "_channels": Pattern.CHANNELS
+}
+
+class PatternEngine(object):
+    """
+    Runs every active pattern off one packed step matrix.
+
+    Each added pattern's `data` lives in a slot of `storage`, a
+    (slots, CHANNELS, SEQ_LEN) uint8 array, so edits show up without any
+    bookkeeping. Subscribe `tick` to the bus in place of every pattern's
+    own `tick`: when a step boundary is crossed it gathers the step's column
+    for the active slots, compares it with what each channel was last given,
+    and calls `channel.tick` only where the value changed. A channel that
+    sets `wake` (a strobe waiting out its width) is ticked again that many
+    fracs later; otherwise a call between step boundaries does nothing.
+
+    `launch` starts or stops a pattern on the next multiple of a quantum.
+    A start has its channels' effects allocated up to a bar ahead, so at
+    the boundary only the step messages go out. `switch` does the same for
+    whole sets of patterns at once (see scenes.py).
+    """
+    def __init__(self, capacity=16):
+        self.storage = numpy.zeros((capacity, Pattern.CHANNELS, Pattern.SEQ_LEN), dtype=numpy.uint8)
+        self.patterns = [None] * capacity
+        self.free = range(capacity)
+        self.lock = threading.Lock()
+        self.active = numpy.zeros(0, dtype=int)
+        self.state = numpy.zeros((0, Pattern.CHANNELS), dtype=numpy.uint8)
+        self.wakes = {}
+        self.due = None
+        self.step = None
+        self.steps = 0
+        self.edges = 0
+        # Quantized launches: [due (fracs since the first tick), pattern, start?, staged? (None: never)]
+        self.launches = []
+        # Launches `advance` has taken for the boundary, until they are applied; still cancellable
+        self.inflight = []
+        # Switches waiting on their boundary: [due, callback before applying, record]
+        self.batches = []
+        self.position = None
+        self.bars = 0
+        self.launched = 0
+
+    def add(self, pattern):
+        with self.lock:
+            if not self.free:
+                self.grow()
+            slot = self.free.pop(0)
+            self.storage[slot] = pattern.data
+            self.patterns[slot] = pattern
+            pattern._data = self.storage[slot]
+            pattern.engine = self
+            pattern.slot = slot
+        if pattern.active:
+            self.set_active(pattern, True)
+
+    def remove(self, pattern):
+        self.set_active(pattern, False)
+        with self.lock:
+            slot = pattern.slot
+            pattern._data = self.storage[slot].copy()
+            pattern.engine = None
+            self.patterns[slot] = None
+            self.storage[slot] = 0
+            self.free.append(slot)
+
+    def grow(self):
+        # Double the storage, and point every pattern at its new slot
+        capacity = len(self.patterns)
+        storage = numpy.zeros((capacity * 2,) + self.storage.shape[1:], dtype=numpy.uint8)
+        storage[:capacity] = self.storage
+        self.storage = storage
+        for slot, pattern in enumerate(self.patterns):
+            if pattern is not None:
+                pattern._data = storage[slot]
+        self.patterns += [None] * capacity
+        self.free += range(capacity, capacity * 2)
+
+    def set_active(self, pattern, active):
+        with self.lock:
+            slot = pattern.slot
+            slots = list(self.active)
+            states = list(self.state)
+            if active and slot not in slots:
+                # Starts from all off, so whatever is on at the next step is an edge
+                slots.append(slot)
+                states.append(numpy.zeros(Pattern.CHANNELS, dtype=numpy.uint8))
+            elif not active and slot in slots:
+                i = slots.index(slot)
+                del slots[i], states[i]
+                for key in [key for key in self.wakes if key[0] == slot]:
+                    del self.wakes[key]
+            self.step = None
+            self.active = numpy.array(slots, dtype=int)
+            self.state = numpy.array(states, dtype=numpy.uint8).reshape(len(slots), Pattern.CHANNELS)
+
+    def launch(self, pattern, quantum):
+        # Toggle `pattern` at the next multiple of `quantum` fracs; launching it again before then cancels
+        with self.lock:
+            now = self.now
+            launch = None
+            # Still cancellable once `advance` has taken it for the boundary, until it is applied
+            for launches in (self.launches, self.inflight):
+                found = [other for other in launches if other[1] is pattern]
+                if found:
+                    launch = found[0]
+                    launches.remove(launch)
+                    break
+            if launch is None and now is not None:
+                # An offloaded pattern's strips would start playing as soon as it is staged
+                staged = None if pattern.offload else False
+                self.launches.append([(now // quantum + 1) * quantum, pattern, not pattern.active, staged])
+                return
+        if launch is not None:
+            if launch[2] and launch[3]:
+                pattern.stop()
+            return
+        # Not ticking yet, so there is no boundary to wait for
+        pattern.toggle()
+
+    def switch(self, starts, stops, quantum, before=None, cancel=(), record=None):
+        """
+        Start and stop sets of patterns together at the next multiple of
+        `quantum` fracs, after calling `before()`. Launches already waiting
+        for them, or for the patterns in `cancel`, are dropped. Nothing is
+        staged ahead, so the stopping patterns' effects can be handed over
+        to the starting ones.
+        Returns `record` (a new dict if None), filled in with what the switch
+        sent once it is applied.
+        """
+        if record is None:
+            record = {}
+        record["requested_ns"] = monotonic_ns()
+        patterns = set(starts) | set(stops) | set(cancel)
+        with self.lock:
+            dropped = [launch for launch in self.launches if launch[1] in patterns]
+            self.launches = [launch for launch in self.launches if launch[1] not in patterns]
+            now = self.now
+            if now is not None:
+                due = (now // quantum + 1) * quantum
+                self.launches += [[due, p, True, None] for p in starts] + [[due, p, False, None] for p in stops]
+                self.batches.append([due, before, record])
+        for launch in dropped:
+            if launch[2] and launch[3] and launch[1] not in starts:
+                launch[1].stop()
+        if now is None:
+            if before is not None:
+                before()
+            self.apply([[None, p, True, None] for p in starts] + [[None, p, False, None] for p in stops], [record])
+        return record
+
+    def pending(self, pattern):
+        return any(launch[1] is pattern for launch in self.launches + self.inflight)
+
+    @property
+    def now(self):
+        if self.position is None:
+            return None
+        return self.bars * Timebase.beats * Timebase.fracs + self.position
+
+    def advance(self, position):
+        # Keep count of bars, then stage and apply whatever launches that brings in range
+        bar = Timebase.beats * Timebase.fracs
+        with self.lock:
+            # Tapping or syncing the timebase can nudge the phase back a little; only a real wrap is a new bar
+            if self.position is not None and position < self.position - bar // 2:
+                self.bars += 1
+            self.position = position
+            if not self.launches and not self.batches:
+                return
+            now = self.now
+            due = [launch for launch in self.launches if launch[0] <= now]
+            stage = [launch for launch in self.launches if launch[0] - now <= bar and launch[2] and launch[3] is False]
+            for launch in stage:
+                # Marked now, so that a cancel from here on stops what staging starts
+                launch[3] = True
+            self.launches = [launch for launch in self.launches if launch[0] > now]
+            self.inflight = due
+            batches = [batch for batch in self.batches if batch[0] <= now]
+            self.batches = [batch for batch in self.batches if batch[0] > now]
+        for launch in stage:
+            launch[1].start()
+        with self.lock:
+            # Whatever was cancelled meanwhile is neither kept staged nor applied
+            listed = self.launches + self.inflight
+            dropped = [launch for launch in stage if not any(launch is other for other in listed)]
+            due = self.inflight
+            self.inflight = []
+        for launch in dropped:
+            launch[1].stop()
+        for due_at, before, record in batches:
+            if before is not None:
+                before()
+        if due or batches:
+            self.apply(due, [record for due_at, before, record in batches])
+
+    def apply(self, launches, records=()):
+        """
+        Start and stop everything in `launches` as one burst. A starting
+        channel takes over the effect of a stopping channel with the same
+        `effect_key` rather than one being stopped and another added.
+        """
+        start = time.time()
+        starts = [launch[1] for launch in launches if launch[2] and not launch[1].active]
+        stops = [launch[1] for launch in launches if not launch[2] and launch[1].active]
+        donors = collections.defaultdict(list)
+        for pattern in stops:
+            for channel in pattern.channels:
+                if channel and channel.started and channel.effect_key is not None:
+                    donors[channel.effect_key].append(channel)
+        handovers = msgs = 0
+        for pattern in starts:
+            if pattern.offload:
+                continue
+            for channel in pattern.channels:
+                if channel and not channel.started and donors.get(channel.effect_key):
+                    msgs += channel.adopt(donors[channel.effect_key].pop())
+                    handovers += 1
+        adds = sum(1 for pattern in starts for channel in pattern.channels if channel and not channel.started)
+        removes = sum(len(pattern.programs) + sum(1 for channel in pattern.channels if channel and channel.started)
+                      for pattern in stops)
+        for pattern in stops + starts:
+            pattern.toggle()
+        self.launched += len(launches)
+        applied = {
+            "applied_ns": monotonic_ns(),
+            "apply_time": time.time() - start,
+            "started": len(starts),
+            "stopped": len(stops),
+            "adds": adds,
+            "stops": removes,
+            "handovers": handovers,
+            "msgs": msgs,
+        }
+        for record in records:
+            record.update(applied)
+
+    def tick(self, time, at=None):
+        # Channel messages go out right away; with look-ahead they are ahead of the step's device tick
+        step = Timebase.step_of(time)
+        position = Timebase.difference(time)
+        bar = Timebase.beats * Timebase.fracs
+        self.advance(position)
+        with self.lock:
+            dispatch = set()
+            if step != self.step:
+                self.step = step
+                self.steps += 1
+                if len(self.active):
+                    values = self.storage[self.active, :, step]
+                    rows, cols = numpy.nonzero(values != self.state)
+                    self.state = values
+                    dispatch.update(zip(self.active[rows].tolist(), cols.tolist()))
+                    self.edges += len(dispatch)
+            if self.due is not None and (position - self.due) % bar < bar // 2:
+                dispatch.update(key for key, due in self.wakes.items() if (position - due) % bar < bar // 2)
+            if not dispatch:
+                return
+            for slot, c in dispatch:
+                pattern = self.patterns[slot]
+                channel = pattern.channels[c]
+                if not channel:
+                    continue
+                # A stop on the UI thread must not land between the channel's checks and its message
+                with pattern.lock:
+                    channel.tick(time, int(self.storage[slot, c, step]))
+                if channel.wake is None:
+                    self.wakes.pop((slot, c), None)
+                else:
+                    self.wakes[slot, c] = (position + channel.wake) % bar
+            self.due = None
+            if self.wakes:
+                self.due = (position + min((due - position) % bar for due in self.wakes.values())) % bar
+
+    def stats(self):
+        return {
+            "waking": len(self.wakes),
+            "launches": len(self.launches),
+            "launched": self.launched,
+            "patterns": len(self.patterns) - len(self.free),
+            "active": len(self.active),
+            "steps": self.steps,
+            "edges": self.edges,
+        }
+
+class PatternLibrary(object):
+    """
+    Every pattern of the night, built only when needed.
+
+    Patterns come from `bank` (a `bank.PatternBank`, or anything with
+    `__len__`, `title(i)` and `materialize(i)`), followed by any `append`ed.
+    `library[i]` builds pattern `i` if it is not already built, adds it to
+    `engine`, and keeps it in a least-recently-used cache of `capacity`.
+    Past that, the least recently used pattern that is neither active nor
+    pinned is evicted: its edits are kept as `Pattern.serialize` data and it
+    is rebuilt from them when next asked for.
+    `title(i)`, `is_active(i)` and `is_pending(i)` never build anything.
+    """
+    def __init__(self, device_manager, bank=None, engine=None, capacity=64):
+        self.device_manager = device_manager
+        self.bank = bank
+        self.engine = engine
+        self.capacity = capacity
+        self.count = len(bank) if bank is not None else 0
+        self.cache = collections.OrderedDict()
+        self.edits = {}
+        self.pinned = set()
+        self.built = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("No pattern %d in library of %d" % (i, self.count))
+        pattern = self.cache.pop(i, None)
+        if pattern is None:
+            pattern = self.build(i)
+        self.cache[i] = pattern
+        self.evict()
+        return pattern
+
+    def build(self, i):
+        if i in self.edits:
+            pattern = Pattern.deserialize(self.edits.pop(i), self.device_manager)
+        else:
+            pattern = self.bank.materialize(i)
+        if self.engine is not None:
+            self.engine.add(pattern)
+        self.built += 1
+        return pattern
+
+    def append(self, pattern):
+        i = self.count
+        self.count += 1
+        if self.engine is not None and pattern.engine is None:
+            self.engine.add(pattern)
+        self.cache[i] = pattern
+        self.evict()
+        return i
+
+    def evict(self):
+        if len(self.cache) <= self.capacity:
+            return
+        for i, pattern in self.cache.items():
+            if pattern.active or pattern.pending or i in self.pinned:
+                continue
+            del self.cache[i]
+            self.edits[i] = pattern.serialize()
+            if pattern.engine is not None:
+                pattern.engine.remove(pattern)
+            # Let it have its own title back when it is rebuilt
+            Pattern.all_titles.discard(pattern.title)
+            self.evicted += 1
+            if len(self.cache) <= self.capacity:
+                return
+
+    def title(self, i):
+        pattern = self.cache.get(i)
+        if pattern is not None:
+            return pattern.title
+        if i in self.edits:
+            return self.edits[i]["title"]
+        return self.bank.title(i)
+
+    def is_active(self, i):
+        pattern = self.cache.get(i)
+        return pattern is not None and pattern.active
+
+    def is_pending(self, i):
+        pattern = self.cache.get(i)
+        return pattern is not None and pattern.pending
+
+    def page(self, n, size):
+        # Indices on page `n` of `size` patterns each
+        return range(n * size, min((n + 1) * size, self.count))
+
+    def stats(self):
+        return {
+            "patterns": self.count,
+            "built": len(self.cache),
+            "builds": self.built,
+            "evicted": self.evicted,
+        }
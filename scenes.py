@@ -0,0 +1,116 @@
+"""
+Named scenes: which patterns of a `PatternLibrary` are running, and how
+their channels are set.
+
+`SceneSwitcher.switch` moves from whatever is running to a scene in one
+go at the next boundary: every pattern that has to start or stop does so
+in the same engine tick, and stopping channels hand their device effects
+over to starting ones, so the burst on the wire is only what differs.
+"""
+import collections
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+class Scene(object):
+    """
+    `patterns` - library indices of the patterns to run
+    `channels` - library index -> list of channel settings (`Channel.describe`
+    dicts, or None to leave a channel be) applied as the scene comes in
+    """
+    def __init__(self, name, patterns, channels=None):
+        self.name = name
+        self.patterns = list(patterns)
+        self.channels = channels or {}
+
+    @classmethod
+    def capture(cls, name, library):
+        # Whatever is running right now
+        patterns = [i for i, pattern in library.cache.items() if pattern.active]
+        channels = dict((i, [c.describe() if c else None for c in library[i].channels]) for i in patterns)
+        return cls(name, patterns, channels)
+
+    def serialize(self):
+        return {"name": self.name, "patterns": self.patterns,
+                "channels": dict((str(i), descs) for i, descs in self.channels.items())}
+
+    @classmethod
+    def deserialize(cls, d):
+        return cls(d["name"], d["patterns"], dict((int(i), descs) for i, descs in d["channels"].items()))
+
+class SceneSwitcher(object):
+    """
+    Switches `library` between named scenes at the next multiple of
+    `quantum` fracs (None: the next frac). `history` keeps a record of the
+    recent switches: the scene, when it was asked for and applied, how long
+    applying took, and the effect adds, stops, handovers and messages sent.
+    """
+    def __init__(self, library, engine, quantum=None, history=32):
+        self.library = library
+        self.engine = engine
+        self.quantum = quantum
+        self.scenes = collections.OrderedDict()
+        self.history = collections.deque(maxlen=history)
+
+    def add(self, scene):
+        self.scenes[scene.name] = scene
+        return scene
+
+    def switch(self, name):
+        scene = self.scenes[name]
+        # Built here rather than on the engine's thread at the boundary
+        targets = [self.library[i] for i in scene.patterns]
+        running = [pattern for pattern in self.library.cache.values() if pattern.active or pattern.pending]
+        starts = [pattern for pattern in targets if not pattern.active]
+        stops = [pattern for pattern in running if pattern not in targets and pattern.active]
+        # Launches still waiting for patterns the switch leaves alone would undo it
+        cancel = [pattern for pattern in running if pattern not in starts + stops]
+
+        settings = [(self.library[i], descs) for i, descs in scene.channels.items()]
+
+        def configure():
+            for pattern, descs in settings:
+                for channel, desc in zip(pattern.channels, descs):
+                    if channel and desc is not None:
+                        channel.configure(desc)
+                pattern.upload()
+
+        record = self.engine.switch(starts, stops, self.quantum or 1, configure, cancel, {"scene": name})
+        self.history.append(record)
+        return record
+
+    @property
+    def current(self):
+        # The scene last applied, if any
+        record = self.last()
+        return record["scene"] if record is not None else None
+
+    def last(self):
+        # The latest switch that has been applied, with its latency in seconds
+        for record in reversed(self.history):
+            if "applied_ns" in record:
+                record = dict(record)
+                record["latency"] = (record["applied_ns"] - record["requested_ns"]) / 1e9
+                return record
+        return None
+
+    def load(self, path):
+        # Add the scenes saved in `path`, if it exists
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for d in json.load(f):
+                self.add(Scene.deserialize(d))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump([scene.serialize() for scene in self.scenes.values()], f)
+
+    def stats(self):
+        return {
+            "scenes": list(self.scenes),
+            "current": self.current,
+            "history": list(self.history),
+        }
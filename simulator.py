@@ -0,0 +1,321 @@
+"""
+In-process stand-in for bespeckle strips.
+
+`SimulatedBespeckleDevice` decodes every frame it is sent, keeps a model of
+the strip's effect stack, and renders the strip into a NumPy array on each
+`CMD_TICK`. The effect models approximate the bespeckle firmware closely
+enough to check what the host sends, not to reproduce it pixel for pixel.
+"""
+import collections
+import colorsys
+import logging
+import threading
+import time
+
+import numpy
+
+from config import *
+from devices import BespeckleDevice, FakeSingleBespeckleDevice
+from framing import FrameDecoder, FrameEncoder
+
+logger = logging.getLogger(__name__)
+
+PIXELS = 50
+
+class EffectModel(object):
+    """
+    Model of one effect on the strip.
+    Override `msg` to take parameters, `tick` to animate,
+    and `render` to draw into an RGBA layer of floats in [0, 1].
+    """
+    effect_class = None
+    effect_name = "(Unknown Effect)"
+
+    def __init__(self, data):
+        self.msg(data)
+
+    def msg(self, data):
+        pass
+
+    def sync(self, f):
+        pass
+
+    def tick(self):
+        pass
+
+    def render(self, layer):
+        pass
+
+def rgba(data):
+    # First four bytes of a message as an RGBA float array
+    return numpy.array(list(data[0:4]) + [0] * (4 - len(data[0:4])), dtype=float) / 255
+
+class SolidColorModel(EffectModel):
+    effect_class = 0x10
+    effect_name = "Solid Color"
+
+    def msg(self, data):
+        self.color = rgba(data)
+
+    def render(self, layer):
+        layer[:] = self.color
+
+class StrobeChannelModel(SolidColorModel):
+    # Driven by `StrobeChannel`: each message sets the colour, clear turns it off
+    effect_class = 0x21
+    effect_name = "Channel Strobe"
+
+class FadeinModel(EffectModel):
+    # [color, 0, rate]: fade in from transparent, `rate` alpha steps per tick
+    effect_class = 0x12
+    effect_name = "Fade to"
+
+    def msg(self, data):
+        self.color = rgba(data)
+        self.rate = max(data[5], 1) / 255.0 if len(data) > 5 else 1.0
+        self.level = 0.0
+
+    def tick(self):
+        self.level = min(self.level + self.rate, 1.0)
+
+    def render(self, layer):
+        layer[:] = self.color
+        layer[:, 3] *= self.level
+
+class PulseModel(EffectModel):
+    # [color, 0, rate] to set up, then [thickness] to launch a pulse.
+    # rate & 0x7 is speed (pixels per tick), rate & 0x8 is direction
+    effect_class = 0x14
+    effect_name = "Pulse"
+
+    def __init__(self, data):
+        self.color = rgba(data)
+        self.rate = data[5] if len(data) > 5 else 0
+        self.pulses = []
+
+    def msg(self, data):
+        self.pulses.append([0, max(data[0], 1)])
+
+    def tick(self):
+        speed = (self.rate & 0x7) + 1
+        for pulse in self.pulses:
+            pulse[0] += speed
+        self.pulses = [p for p in self.pulses if p[0] - p[1] < PIXELS]
+
+    def render(self, layer):
+        for position, thickness in self.pulses:
+            lo, hi = max(position - thickness, 0), min(position, PIXELS)
+            if self.rate & 0x8:
+                lo, hi = PIXELS - hi, PIXELS - lo
+            layer[lo:hi] = self.color
+
+class SwipeModel(PulseModel):
+    # Like a pulse, but leaves the strip filled behind it
+    effect_class = 0x16
+    effect_name = "Swipe"
+
+    def msg(self, data):
+        self.pulses = [[0, PIXELS]]
+
+    def tick(self):
+        speed = (self.rate & 0x7) + 1
+        for pulse in self.pulses:
+            pulse[0] = min(pulse[0] + speed, PIXELS)
+
+class StrobeModel(EffectModel):
+    # [color, period, duty]: on for `duty`/256 of every `period` ticks
+    effect_class = 0x18
+    effect_name = "Strobe"
+
+    def msg(self, data):
+        self.color = rgba(data)
+        self.period = max(data[4], 1) if len(data) > 4 else 1
+        self.duty = data[5] if len(data) > 5 else 255
+        self.phase = 0
+
+    def sync(self, f):
+        self.phase = 0
+
+    def tick(self):
+        self.phase = (self.phase + 1) % self.period
+
+    def render(self, layer):
+        if self.phase * 256 < self.duty * self.period:
+            layer[:] = self.color
+
+class RainbowModel(EffectModel):
+    # [start, t_period, l_period]: hue cycles along the strip and over time
+    effect_class = 0x03
+    effect_name = "Rainbow"
+
+    def msg(self, data):
+        self.hue = data[0] / 255.0
+        self.t_period = max(data[1], 1)
+        self.l_period = max(data[2], 1)
+
+    def tick(self):
+        self.hue = (self.hue + 1.0 / (16 * self.t_period)) % 1.0
+
+    def render(self, layer):
+        for i in range(PIXELS):
+            h = (self.hue + float(i) / (PIXELS * self.l_period)) % 1.0
+            layer[i, 0:3] = colorsys.hsv_to_rgb(h, 1, 1)
+            layer[i, 3] = 1.0
+
+class SequencerModel(EffectModel):
+    # [color, hold, length, steps]: plays one step per tick from the step the last sync named;
+    # lit steps show `color`, which stays up for `hold` ticks after each run (see `Channel.program`)
+    effect_class = 0x30
+    effect_name = "Sequencer"
+
+    def __init__(self, data):
+        self.step = 0
+        self.lit = 0
+        self.msg(data)
+
+    def msg(self, data):
+        self.color = rgba(data)
+        self.hold = data[4] if len(data) > 4 else 0
+        self.length = max(data[5], 1) if len(data) > 5 else 1
+        bits = numpy.unpackbits(numpy.array(data[6:], dtype=numpy.uint8))[:self.length]
+        self.steps = numpy.zeros(self.length, dtype=numpy.uint8)
+        self.steps[:len(bits)] = bits
+
+    def sync(self, f):
+        self.step = f
+
+    def tick(self):
+        if self.steps[self.step % self.length]:
+            self.lit = self.hold + 1
+        elif self.lit:
+            self.lit -= 1
+        self.step += 1
+
+    def render(self, layer):
+        if self.lit:
+            layer[:] = self.color
+
+EFFECT_MODELS = dict((model.effect_class, model) for model in [
+    SolidColorModel, StrobeChannelModel, FadeinModel, PulseModel, SwipeModel, StrobeModel, RainbowModel,
+    SequencerModel,
+])
+
+class SimulatedBespeckleDevice(FakeSingleBespeckleDevice):
+    """
+    A fake device that decodes and executes everything it is sent.
+
+    Frames are checksum-verified (`strip_decoder.errors` counts bad ones),
+    effects are stacked in the order they were added, and `pixels` holds the
+    last rendered strip as a (PIXELS, 4) uint8 RGBA array. Frames flagged
+    `FLAG_ACK` are echoed back. With `realtime`, writes and echoes take as
+    long as they would on the wire. `step` counts ticks from the last
+    `CMD_SYNC`, and new effects start in phase with it.
+    """
+    # It always echoes, so it is always probed
+    probing = True
+
+    def __init__(self, port=None, baudrate=115200, queue_size=256, realtime=False):
+        self.realtime = realtime
+        self.strip_decoder = FrameDecoder()
+        self.strip_encoder = FrameEncoder()
+        self.effects = collections.OrderedDict()
+        self.pixels = numpy.zeros((PIXELS, 4), dtype=numpy.uint8)
+        self.layer = numpy.zeros((PIXELS, 4), dtype=float)
+        self.lock = threading.Lock()
+        self.ticks = 0
+        self.step = 0
+        self.commands = collections.Counter()
+        self.unknown = 0
+        FakeSingleBespeckleDevice.__init__(self, port, baudrate, queue_size)
+        self.write_inline = WRITE_INLINE and not realtime
+
+    def write(self, data):
+        if self.realtime:
+            FakeSingleBespeckleDevice.write(self, data)
+        for flags, addr, payload in self.strip_decoder.feed(data):
+            if flags & self.FLAG_ACK:
+                self.rx.put(self.strip_encoder.encode(payload, flags, addr))
+            self.execute(payload)
+
+    def read(self):
+        data = FakeSingleBespeckleDevice.read(self)
+        if self.realtime and data:
+            # The echo takes as long to come back as it took to send
+            time.sleep(len(data) * 10.0 / self.baudrate)
+        return data
+
+    def execute(self, data):
+        cmd = data[0]
+        self.commands[cmd] += 1
+        with self.lock:
+            if cmd == self.CMD_TICK:
+                self.ticks += 1
+                for effect in self.effects.values():
+                    effect.tick()
+                self.step += 1
+                self.render()
+            elif cmd == self.CMD_SYNC:
+                self.step = data[1]
+                for effect in self.effects.values():
+                    effect.sync(data[1])
+            elif cmd == self.CMD_RESET:
+                self.effects.clear()
+            elif cmd == self.CMD_MSG:
+                effect = self.effects.get(data[1])
+                if effect is not None:
+                    effect.msg(data[2:])
+            elif cmd == self.CMD_STOP:
+                self.effects.pop(data[1], None)
+            elif cmd == self.CMD_PARAM:
+                pass # Calibration
+            elif cmd < 0x80:
+                model = EFFECT_MODELS.get(cmd)
+                if model is None:
+                    self.unknown += 1
+                    model = EffectModel
+                # A new effect replaces any effect with the same id
+                self.effects.pop(data[1], None)
+                self.effects[data[1]] = model(data[2:])
+                self.effects[data[1]].sync(self.step)
+
+    def render(self):
+        # Composite the effect stack over black
+        out = numpy.zeros((PIXELS, 3), dtype=float)
+        layer = self.layer
+        for effect in self.effects.values():
+            layer.fill(0)
+            effect.render(layer)
+            alpha = layer[:, 3:4]
+            out = out * (1 - alpha) + layer[:, 0:3] * alpha
+        self.pixels[:, 0:3] = numpy.clip(out * 255 + 0.5, 0, 255)
+        self.pixels[:, 3] = 255
+
+    def snapshot(self):
+        with self.lock:
+            return self.pixels.copy()
+
+class SimulatedCanBus(object):
+    """
+    Lets the CAN-era `Effect` classes in effects.py drive simulated devices:
+    `can_packet(device_id, data)` frames `data` to `devices[device_id]`.
+    The effects pick their own ids, so the device's `shadow` is kept up to
+    date here and their messages go through `bespeckle_msg_effect`.
+    """
+    CMD_MSG = BespeckleDevice.CMD_MSG
+    CMD_STOP = BespeckleDevice.CMD_STOP
+
+    def __init__(self, devices):
+        self.devices = devices
+
+    def can_packet(self, device_id, data):
+        dev = self.devices[device_id]
+        data = list(data)
+        if data[0] == self.CMD_MSG:
+            dev.bespeckle_msg_effect(data[1], data[2:], lane=dev.LANE_CONTROL)
+            return
+        with dev.shadow_lock:
+            dev.framed_packet(data)
+            if data[0] == self.CMD_STOP:
+                dev.shadow.pop(data[1], None)
+            elif data[0] < 0x80:
+                dev.shadow[data[1]] = [data[0], tuple(data[2:]), None]
@@ -0,0 +1,73 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Histogram(object):
+    """
+    Histogram of durations in power-of-two microsecond buckets.
+    Bucket `i` counts durations below 2**i microseconds (and at least 2**(i-1)).
+    Recording is cheap enough for the device writer threads.
+    """
+    def __init__(self, buckets=26):
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = int(seconds * 1e6).bit_length()
+        if bucket >= len(self.counts):
+            bucket = len(self.counts) - 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the `p` quantile, in seconds
+        if not self.count:
+            return 0.0
+        target = p * self.count
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "max": self.max,
+            "p50": self.percentile(0.50),
+            "p99": self.percentile(0.99),
+            "buckets_us": dict((1 << i, n) for i, n in enumerate(self.counts) if n),
+        }
+
+def format_seconds(seconds):
+    if seconds < 0.001:
+        return "{:.0f}us".format(seconds * 1e6)
+    return "{:.1f}ms".format(seconds * 1e3)
+
+def format_bytes(n):
+    if n < 1024:
+        return "{}B".format(n)
+    if n < 1024 * 1024:
+        return "{:.1f}kB".format(n / 1024.0)
+    return "{:.1f}MB".format(n / (1024.0 * 1024))
+
+def dump_stats(stats, path):
+    try:
+        with open(path, "w") as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+    except IOError:
+        logger.exception("Unable to write stats to %s", path)
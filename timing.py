@@ -1,62 +1,328 @@
+import collections
+import fractions
 import logging
+import os
+import threading
 import time
 
 from config import *
 
 logger = logging.getLogger(__name__)
 
+try:
+    monotonic_ns = time.monotonic_ns
+except AttributeError:
+    # Python 2 has no monotonic clock; read CLOCK_MONOTONIC through libc
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"), use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic_ns():
+        ts = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return ts.tv_sec * 1000000000 + ts.tv_nsec
+
+SCHED_FIFO = 1
+
+def _libc():
+    import ctypes
+    import ctypes.util
+    return ctypes, ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+def set_thread_affinity(cpus):
+    """
+    Restrict the calling thread to `cpus`; threads it starts inherit this.
+    Returns False if the kernel refused.
+    """
+    cpus = set(cpus)
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError:
+            return False
+        return True
+    ctypes, libc = _libc()
+    words = 1024 // (8 * ctypes.sizeof(ctypes.c_ulong))
+    mask = (ctypes.c_ulong * words)()
+    for cpu in cpus:
+        mask[cpu // (8 * ctypes.sizeof(ctypes.c_ulong))] |= 1 << (cpu % (8 * ctypes.sizeof(ctypes.c_ulong)))
+    return libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) == 0
+
+def set_thread_fifo(priority):
+    # Give the calling thread SCHED_FIFO `priority` (1-99); False if not permitted
+    if hasattr(os, "sched_setscheduler"):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except OSError:
+            return False
+        return True
+    ctypes, libc = _libc()
+    param = ctypes.c_int(priority) # struct sched_param is a single int
+    return libc.sched_setscheduler(0, SCHED_FIFO, ctypes.byref(param)) == 0
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def reserve_cpu(cpu):
+    """
+    Keep the calling thread, and every thread it starts from now on, off
+    `cpu`, leaving it to the threads `realtime_thread` moves there.
+    Call early, from the main thread.
+    """
+    others = set(range(cpu_count())) - set([cpu])
+    if not others:
+        logger.warning("Only one CPU; not reserving CPU %d", cpu)
+        return False
+    if not set_thread_affinity(others):
+        logger.warning("Unable to reserve CPU %d", cpu)
+        return False
+    return True
+
+def realtime_thread(cpu=None, priority=None):
+    """
+    Move the calling thread onto `cpu` and/or give it SCHED_FIFO `priority`.
+    Whatever is not permitted is logged and skipped; the thread carries on
+    with the default scheduler. Returns what was applied.
+    """
+    applied = {"cpu": None, "priority": None}
+    if cpu is not None:
+        if set_thread_affinity([cpu]):
+            applied["cpu"] = cpu
+        else:
+            logger.warning("Unable to pin thread to CPU %d", cpu)
+    if priority is not None:
+        if set_thread_fifo(priority):
+            applied["priority"] = priority
+        else:
+            logger.warning("Unable to set SCHED_FIFO priority %d (needs CAP_SYS_NICE or an rtprio limit)", priority)
+    return applied
+
+class TapTempo(object):
+    """
+    Incremental tap-tempo estimator.
+
+    Each accepted tap is numbered with the beat it falls on (so a skipped
+    beat is fine) and the tempo is a least-squares line through the last
+    `window` taps, kept as running sums: O(1) per tap. The slope is the
+    `period` and the line gives the `phase`, the fitted time of the latest
+    tapped beat.
+
+    A tap further than `tolerance` periods from where the line predicts is
+    rejected as an outlier; after `max_rejects` outliers in a row the tempo
+    is assumed to have changed and the estimate restarts from them. A gap of
+    more than `timeout` seconds also starts over.
+
+    `confidence` runs from 0 (nothing to go on) to 1 (a full window of taps
+    that fit the line to within a few percent of a beat).
+    """
+    def __init__(self, window=8, tolerance=0.25, max_rejects=2, timeout=2.0):
+        self.window = window
+        self.tolerance = tolerance
+        self.max_rejects = max_rejects
+        self.timeout = timeout
+        self.rejected = 0
+        self.reset()
+
+    def reset(self, taps=()):
+        self.taps = collections.deque()
+        self.sums = [0.0] * 5 # n, x, y, xx, xy
+        self.ysum2 = 0.0 # yy, for the residual
+        self.origin = None
+        self.period = None
+        self.phase = None
+        self.rejects = []
+        for t in taps:
+            self.tap(t)
+
+    def add(self, x, y):
+        self.taps.append((x, y))
+        self.update(x, y, 1)
+        if len(self.taps) > self.window:
+            self.update(*(self.taps.popleft() + (-1,)))
+        n, sx, sy, sxx, sxy = self.sums
+        if n >= 2:
+            self.period = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+            intercept = (sy - self.period * sx) / n
+            self.phase = self.origin + intercept + self.period * x
+
+    def update(self, x, y, sign):
+        sums = self.sums
+        sums[0] += sign
+        sums[1] += sign * x
+        sums[2] += sign * y
+        sums[3] += sign * x * x
+        sums[4] += sign * x * y
+        self.ysum2 += sign * y * y
+
+    def tap(self, t):
+        # Returns True if the tap was used
+        if not self.taps or t - self.origin - self.taps[-1][1] > self.timeout:
+            self.reset()
+            self.origin = t
+            self.add(0, 0.0)
+            return True
+        last_x, last_y = self.taps[-1]
+        y = t - self.origin
+        if self.period is None:
+            self.add(last_x + 1, y)
+            return True
+        x = last_x + int(round((y - last_y) / self.period))
+        error = abs(t - self.predict(x)) / self.period
+        if x == last_x or error > self.tolerance:
+            self.rejected += 1
+            self.rejects.append(t)
+            if len(self.rejects) >= self.max_rejects:
+                # Consistent "outliers" mean the tempo changed
+                self.reset(self.rejects)
+            return False
+        self.rejects = []
+        self.add(x, y)
+        return True
+
+    def predict(self, x):
+        # Fitted time of tapped beat `x`
+        last_x = self.taps[-1][0]
+        return self.phase + (x - last_x) * self.period
+
+    @property
+    def residual(self):
+        # RMS distance of the taps from the fitted line, in seconds
+        n, sx, sy, sxx, sxy = self.sums
+        if n < 3:
+            return None
+        b = self.period
+        a = (sy - b * sx) / n
+        sse = self.ysum2 - 2 * a * sy - 2 * b * sxy + n * a * a + 2 * a * b * sx + b * b * sxx
+        return (max(sse, 0.0) / n) ** 0.5
+
+    @property
+    def confidence(self):
+        n = len(self.taps)
+        if n < 2 or self.period <= 0:
+            return 0.0
+        residual = self.residual or 0.0
+        fit = max(0.0, 1.0 - residual / (0.1 * self.period))
+        return min(float(n - 1) / (self.window - 1), 1.0) * fit
+
 class Timebase(object):
     """
     Keep track of timing
     `beat` - 0-indexed number of full beats since the downbeat. Counts up to `self.beats`,
              usually 4. Ex: "ONE two three four ONE two three four" -> [0, 1, 2, 3, 0, 1, 2, 3]
-    `frac` - 0-indexed number of fractional beats since the last beat. Counts up to `self.fracs`
-             usually 240.
+    `frac` - 0-indexed number of fractional beats since the last beat. Counts up to `self.fracs`,
+             `steps` * `step_fracs`: 240 by default.
+    `step` - 0-indexed sequencer step in the bar, `steps` to a beat. Patterns, the
+             sequencer grid and device ticks all work in steps.
     `tick` - A tuple, `(beat, frac)`.
+    `position` - Number of fracs since the anchor, a downbeat. `tick` is derived from it.
+
+    The position is a pure function of the monotonic clock:
+        position = (now_ns - anchor_ns) * fracs // period_ns
+    `(anchor_ns, period_ns)` is only ever replaced as a whole, so any thread can
+    read the time without locking and always gets a consistent answer.
+    Tempo changes move the anchor so that the position carries on from where it was.
+
+    Times passed to `sync` and `tap` are wall-clock seconds, as from `ev.timestamp()`.
     """
     beats = 4
-    fracs = 240
+    steps = 8 # Sequencer steps per beat
+    step_fracs = FRACTICK_FRAC # Set with `set_resolution`
+    fracs = steps * step_fracs
     # Thanks @ervanalb !
     def __init__(self):
-        self.taps = []
-        self.beat = -1
-        self.period = 0.5
-        self.nextTick = time.time()
-
-    def update(self, t):
-        if t>=self.nextTick:
-            self.lastTick=self.nextTick
-            self.nextFracTick=self.nextTick
-            self.nextTick+=self.period
-            self.frac=-1
-            self.beat+=1
-            if self.beat>=self.beats:
-                self.beat=0
-        if t>=self.nextFracTick:
-            real_frac=int(self.fracs*(t-self.lastTick)/self.period)
-            if real_frac<self.fracs and real_frac>self.frac:
-                self.frac=real_frac
-            self.nextFracTick=self.lastTick+float(real_frac+1)*self.period/self.fracs
+        self.tapper = TapTempo()
+        self.lock = threading.Lock() # Serializes writers only
+        self.state = (monotonic_ns(), 500000000)
+
+    @classmethod
+    def set_resolution(cls, step_fracs):
+        """
+        Set the tick resolution, in fracs per step. Everything derives its
+        step math from here, so set it before starting anything that ticks.
+        """
+        if step_fracs < 1:
+            raise Exception("Invalid tick resolution %r" % step_fracs)
+        cls.step_fracs = step_fracs
+        cls.fracs = cls.steps * step_fracs
+
+    @classmethod
+    def step_of(cls, tick):
+        beat, frac = tick
+        return beat * cls.steps + frac // cls.step_fracs
+
+    @staticmethod
+    def to_monotonic_ns(t):
+        # Wall-clock seconds -> monotonic nanoseconds
+        return monotonic_ns() - int((time.time() - t) * 1e9)
+
+    def position(self, now=None):
+        anchor, period = self.state
+        if now is None:
+            now = monotonic_ns()
+        return (now - anchor) * self.fracs // period
+
+    def time_of(self, position):
+        # Monotonic ns at which `position` starts
+        anchor, period = self.state
+        return anchor - (-position * period // self.fracs)
+
+    @classmethod
+    def tick_of(cls, position):
+        return ((position // cls.fracs) % cls.beats, position % cls.fracs)
+
+    def tick(self, now=None):
+        return self.tick_of(self.position(now))
+
+    @property
+    def period(self):
+        return self.state[1] / 1e9
+
+    @period.setter
+    def period(self, period):
+        self.set_period_ns(int(period * 1e9))
+
+    def set_period_ns(self, period_ns, now=None):
+        with self.lock:
+            if now is None:
+                now = monotonic_ns()
+            anchor, old_period = self.state
+            # Rounded so that the position never steps backwards
+            elapsed = -(-(now - anchor) * period_ns // old_period)
+            self.state = (now - elapsed, period_ns)
 
     def sync(self, t):
-        if abs(t-self.nextTick) < abs(t-self.lastTick):
-            self.beat=-1
-            self.nextTick=t
-        else:
-            self.beat=0
-            self.nextTick=t+self.period
+        # The beat nearest to `t` becomes the downbeat
+        with self.lock:
+            self.state = (self.to_monotonic_ns(t), self.state[1])
 
     def nudge(self, t):
         self.period = 60.0 / (self.bpm + t)
 
     def tap(self, t):
-        self.taps.append(t)
-        self.taps=[tap for tap in self.taps if tap > t-2][0:5] # Take away everything older than 2sec or more than 5 history
-        diffs=[self.taps[i]-self.taps[i-1] for i in range(1,len(self.taps))] # First differences
-        if len(diffs)==0:
-                return
-        mean=sum(diffs)/len(diffs)
-        self.period=mean
+        # Locks both tempo and phase to the taps: the tapped beat lands on a beat
+        if not self.tapper.tap(t) or self.tapper.period is None:
+            return
+        if not 20 <= 60.0 / self.tapper.period <= 500:
+            return
+        self.set_phase_ns(self.to_monotonic_ns(self.tapper.phase), int(self.tapper.period * 1e9))
+
+    def set_phase_ns(self, t, period_ns):
+        # Make the beat nearest to `t` start at `t`, and set the period
+        with self.lock:
+            anchor, old_period = self.state
+            beats = int(round(float(t - anchor) / old_period))
+            self.state = (t - beats * period_ns, period_ns)
 
     def quantize(self,nearest=2):
         bpm=60.0/self.period
@@ -70,14 +336,9 @@ class Timebase(object):
         return 60.0 / self.period
 
     def multiply(self,factor):
-        self.period/=factor
-        if self.bpm > 500 or self.bpm < 20:
-            # Undo; set limits
-            self.period *= factor
-
-    def tick(self):
-        self.update(time.time())
-        return (self.beat, self.frac)
+        period = self.period / factor
+        if 20 <= 60.0 / period <= 500:
+            self.period = period
 
     @classmethod
     def difference(cls, t1, t2=None):
@@ -96,3 +357,202 @@ class Timebase(object):
         beat, frac = time
         br = tmax / cls.beats
         return br * beat + br * frac / cls.fracs 
+
+class TickScheduler(object):
+    """
+    Calls `callback(tick)` from a background thread each time the timebase
+    crosses a multiple of `resolution` fracs.
+
+    Modes:
+    `deadline` - sleep until the next boundary, re-planning at least every
+                 `replan_interval` seconds to follow tempo changes
+    `poll` - poll the timebase every 0.1ms
+
+    `skipped` counts boundaries that were never delivered because the thread
+    woke up too late. `report()` summarizes CPU use and lateness.
+
+    `cpu` and `priority` run the thread pinned and/or under SCHED_FIFO,
+    where permitted; see `realtime_thread`.
+    """
+    MODES = ("deadline", "poll")
+    POLL_INTERVAL = 0.0001
+
+    def __init__(self, timebase, callback, resolution=1, mode="deadline", replan_interval=0.005, samples=4096,
+                 cpu=None, priority=None):
+        if mode not in self.MODES:
+            raise Exception("Unknown scheduler mode '%s'" % mode)
+        self.timebase = timebase
+        self.callback = callback
+        self.resolution = resolution
+        self.mode = mode
+        self.replan_interval = replan_interval
+        self.lateness = collections.deque(maxlen=samples)
+        self.ticks = 0
+        self.skipped = 0
+        self.running = False
+        self.cpu = cpu
+        self.priority = priority
+        self.realtime = None
+
+    def start(self):
+        self.running = True
+        self.start_time = time.time()
+        self.start_cpu = sum(os.times()[0:2])
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        if self.cpu is not None or self.priority is not None:
+            self.realtime = realtime_thread(self.cpu, self.priority)
+        tb = self.timebase
+        last = None
+        while self.running:
+            resolution = self.resolution
+            now = monotonic_ns()
+            boundary = tb.position(now) // resolution * resolution
+            if boundary != last:
+                if last is not None and boundary > last:
+                    self.skipped += max((boundary - last) // resolution - 1, 0)
+                    self.lateness.append((now - tb.time_of(boundary)) / 1e9)
+                self.ticks += 1
+                self.fire(boundary)
+                last = boundary
+                now = monotonic_ns()
+            if self.mode == "deadline":
+                delay = (tb.time_of(last + resolution) - now) / 1e9
+                time.sleep(min(max(delay, 0), self.replan_interval))
+            else:
+                time.sleep(self.POLL_INTERVAL)
+
+    def fire(self, position):
+        self.callback(self.timebase.tick_of(position))
+
+    def report(self):
+        wall = time.time() - self.start_time
+        cpu = sum(os.times()[0:2]) - self.start_cpu
+        lateness = sorted(self.lateness)
+        def percentile(p):
+            if not lateness:
+                return 0.0
+            return lateness[min(int(len(lateness) * p), len(lateness) - 1)]
+        return {
+            "mode": self.mode,
+            "realtime": self.realtime,
+            "ticks": self.ticks,
+            "skipped": self.skipped,
+            "cpu": cpu / wall if wall > 0 else 0.0,
+            "late_p50": percentile(0.50),
+            "late_p99": percentile(0.99),
+            "late_max": lateness[-1] if lateness else 0.0,
+        }
+
+class TickBus(TickScheduler):
+    """
+    Publishes timebase boundaries to any number of subscribers from one thread.
+
+    Each subscriber picks a `resolution`, a number of fracs or one of `FRAC`,
+    `STEP`, `BEAT` and `BAR` (which follow `Timebase.set_resolution`), and
+    gets `callback(tick)` exactly once for every boundary it crosses. The
+    thread only wakes as often as the finest resolution subscribed.
+
+    If the thread wakes up too late, `catch_up` decides what happens to the
+    steps it missed:
+    `all` - replay each missed step start, in order, to every subscriber,
+            then the current boundary (at most a bar is replayed)
+    `final` - deliver only the current boundary
+    `drop` - if whole steps were missed, skip every boundary up to now and
+             deliver nothing until the next one
+    `replayed` and `dropped` count how often each happened.
+
+    Subscribers that must run on another thread (e.g. the UI) pass a `queue`,
+    which receives `(callback, args)` instead of the call.
+
+    Subscribers with a `lead` are called `lead` fracs before each boundary,
+    as `callback(tick, at)`, where `at` is when the boundary falls in
+    monotonic nanoseconds.
+    """
+    FRAC = 1
+    STEP = "step"
+    BEAT = "beat"
+    BAR = "bar"
+    CATCH_UP = ("all", "final", "drop")
+
+    def __init__(self, timebase, mode="deadline", catch_up="all", **kwargs):
+        if catch_up not in self.CATCH_UP:
+            raise Exception("Unknown catch-up policy '%s'" % catch_up)
+        TickScheduler.__init__(self, timebase, None, resolution=timebase.fracs, mode=mode, **kwargs)
+        self.catch_up = catch_up
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.last_position = None
+        self.replayed = 0
+        self.dropped = 0
+
+    def subscribe(self, callback, resolution=FRAC, queue=None, lead=0):
+        # Returns a handle for `unsubscribe`
+        resolution = self.fracs_in(resolution)
+        sub = [callback, resolution, queue, (self.timebase.position() + lead) // resolution, lead]
+        with self.lock:
+            self.subscribers = self.subscribers + [sub]
+            self.update_resolution()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not sub]
+            self.update_resolution()
+
+    def report(self):
+        report = TickScheduler.report(self)
+        report.update(catch_up=self.catch_up, replayed=self.replayed, dropped=self.dropped)
+        return report
+
+    def fracs_in(self, resolution):
+        tb = self.timebase
+        return {self.STEP: tb.step_fracs, self.BEAT: tb.fracs, self.BAR: tb.fracs * tb.beats}.get(resolution, resolution)
+
+    def update_resolution(self):
+        # Every subscriber's boundaries, shifted by its lead, have to be bus boundaries
+        resolutions = [sub[1] for sub in self.subscribers] + [sub[4] for sub in self.subscribers if sub[4]]
+        self.resolution = reduce(fractions.gcd, resolutions) if resolutions else self.timebase.fracs
+
+    def fire(self, position):
+        last, self.last_position = self.last_position, position
+        if last is not None and last < position:
+            tb = self.timebase
+            step = tb.step_fracs
+            if self.catch_up == "drop" and position // step - last // step > 1:
+                # Skip the late boundaries, so they don't arrive one wake later instead
+                for sub in self.subscribers:
+                    sub[3] = (position + sub[4]) // sub[1]
+                self.dropped += 1
+                return
+            if self.catch_up == "all":
+                # Step starts passed over since the last wake, oldest first
+                first = max(last // step + 1, (position - 1) // step - tb.steps * tb.beats + 1)
+                for s in range(first, (position - 1) // step + 1):
+                    self.replayed += 1
+                    self.deliver(s * step)
+        self.deliver(position)
+
+    def deliver(self, position):
+        for sub in self.subscribers: # Replaced, never mutated, by (un)subscribe
+            callback, resolution, queue, last, lead = sub
+            boundary = (position + lead) // resolution
+            if boundary == last:
+                continue
+            sub[3] = boundary
+            tick = self.timebase.tick_of(boundary * resolution)
+            args = (tick, self.timebase.time_of(boundary * resolution)) if lead else (tick,)
+            if queue is not None:
+                queue.put((callback, args))
+                continue
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Tick subscriber %r failed", callback)
@@ -0,0 +1,136 @@
+"""
+Binary capture and replay of device traffic.
+
+A capture file is the 8-byte `MAGIC`, followed by one record per packet
+written to a device:
+    uint64 timestamp (monotonic ns), uint16 device index, uint16 length, payload
+All fields are little-endian with no padding, so a capture can be read in
+place through `mmap`.
+
+Usage: python wire.py CAPTURE [--speed N | --fast] [--fake] [--dump]
+"""
+import argparse
+import logging
+import mmap
+import struct
+import threading
+import time
+
+from timing import monotonic_ns
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CLWIRE1\n"
+RECORD = struct.Struct("<QHH")
+
+class WireRecorder(object):
+    """
+    Appends every packet handed to a device's port to a capture file.
+    Called from each device's writer thread.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "wb")
+        self.f.write(MAGIC)
+        self.lock = threading.Lock()
+        self.records = 0
+
+    def record(self, index, data):
+        header = RECORD.pack(monotonic_ns(), index, len(data))
+        with self.lock:
+            self.f.write(header)
+            self.f.write(data)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+class WireLog(object):
+    """
+    Read-only view of a capture file.
+    Iterating yields `(timestamp_ns, device_index, payload)`.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[0:len(MAGIC)] != MAGIC:
+            raise Exception("%s is not a wire capture" % path)
+
+    def __iter__(self):
+        mm = self.mm
+        offset = len(MAGIC)
+        end = len(mm)
+        while offset + RECORD.size <= end:
+            timestamp, index, length = RECORD.unpack_from(mm, offset)
+            offset += RECORD.size
+            if offset + length > end:
+                logger.warning("%s: truncated record at offset %d", self.path, offset)
+                return
+            yield timestamp, index, mm[offset:offset + length]
+            offset += length
+
+    def close(self):
+        self.mm.close()
+
+class WireReplayer(object):
+    """
+    Sends a capture back out to `devices`, indexed by the recorded device index.
+    `speed` scales the recorded timing (2.0 plays twice as fast);
+    `None` sends everything as fast as possible.
+    """
+    def __init__(self, log, devices, speed=1.0):
+        self.log = log
+        self.devices = devices
+        self.speed = speed
+        self.packets = 0
+        self.skipped = 0
+
+    def run(self):
+        start = None
+        for timestamp, index, payload in self.log:
+            if start is None:
+                start = (monotonic_ns(), timestamp)
+            if self.speed is not None:
+                due = start[0] + (timestamp - start[1]) / self.speed
+                delay = (due - monotonic_ns()) / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+            if index >= len(self.devices):
+                self.skipped += 1
+                continue
+            self.devices[index].raw_packet(payload)
+            self.packets += 1
+        for dev in self.devices:
+            dev.flush()
+        return self.packets
+
+def main():
+    from devices import FakeSingleBespeckleDevice, load_topology
+
+    parser = argparse.ArgumentParser(description="Replay a capture of device traffic")
+    parser.add_argument("capture")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed multiplier")
+    parser.add_argument("--fast", action="store_true", help="Send as fast as possible")
+    parser.add_argument("--fake", action="store_true", help="Replay to fake devices instead of serial ports")
+    parser.add_argument("--dump", action="store_true", help="Print the records instead of replaying them")
+    args = parser.parse_args()
+
+    log = WireLog(args.capture)
+    if args.dump:
+        for timestamp, index, payload in log:
+            print "{:.6f} {:>3} {}".format(timestamp / 1e9, index, ';'.join("{:02x}".format(x) for x in bytearray(payload)))
+        return
+
+    device_manager = load_topology(device_class=FakeSingleBespeckleDevice if args.fake else None)
+    replayer = WireReplayer(log, device_manager.devices, None if args.fast else args.speed)
+    start = time.time()
+    packets = replayer.run()
+    elapsed = time.time() - start
+    device_manager.close()
+    print "Replayed {} packets in {:.3f}s ({:.0f} packets/sec), {} for missing devices".format(
+            packets, elapsed, packets / elapsed if elapsed else 0, replayer.skipped)
+
+if __name__ == "__main__":
+    main()